@@ -24,14 +24,19 @@ class Scheduler:
         heapq.heappush(self.sleeping, (deadline, self.sequence, func))
 
     def run(self):
+        # One tick at a time (as in async_cb_coro.py): due timers join the
+        # ready queue, then only the callbacks ready at that point run, so
+        # one that keeps rescheduling itself can't hold back the timers
         while self.ready or self.sleeping:
             if not self.ready:
-                deadline, _, func = heapq.heappop(self.sleeping)
-                delta = deadline - time.time()
+                delta = self.sleeping[0][0] - time.time()
                 if delta > 0:
                     time.sleep(delta)
+            now = time.time()
+            while self.sleeping and self.sleeping[0][0] <= now:
+                deadline, _, func = heapq.heappop(self.sleeping)
                 self.ready.append(func)
-            while self.ready:
+            for _ in range(len(self.ready)):
                 func = self.ready.popleft()
                 func()
 
@@ -89,6 +94,61 @@ class AsyncQueue:
             else:
                 self.waiting.append(lambda: self.get(callback))
 
+    def put_many(self, items):
+        if self._closed:
+            raise QueueClosed()
+
+        self.items.extend(items)
+        # One wakeup per new item at most, however many getters are waiting
+        for _ in range(min(len(self.waiting), len(self.items))):
+            sched.call_soon(self.waiting.popleft())
+
+    def get_many(self, callback, max_items, timeout=None):
+        # Like get(), but the Result holds a list of up to max_items items,
+        # so a busy consumer gets one callback per batch instead of per item.
+        # An empty list means timeout (seconds) ran out with nothing to get.
+        # This Scheduler's timers can't be cancelled: the timeout stays in
+        # sched.sleeping (and keeps run() going) until it expires, even when
+        # a batch was delivered long before.
+        if self.items or self._closed:
+            self._deliver_many(callback, max_items)
+            return
+
+        pending = True
+
+        def _wake():
+            nonlocal pending
+            if not pending:
+                return
+            if self.items or self._closed:
+                pending = False
+                self._deliver_many(callback, max_items)
+            else:
+                self.waiting.append(_wake)  # Beaten to the item: keep waiting
+
+        def _expire():
+            nonlocal pending
+            if pending:
+                pending = False
+                if _wake in self.waiting:
+                    self.waiting.remove(_wake)
+                elif self.items and self.waiting:
+                    # A put already used up a wakeup on us (it's queued, and
+                    # will now do nothing): give it to the next getter
+                    sched.call_soon(self.waiting.popleft())
+                callback(Result(value=[]))
+
+        self.waiting.append(_wake)
+        if timeout is not None:
+            sched.call_later(timeout, _expire)
+
+    def _deliver_many(self, callback, max_items):
+        if self.items:
+            count = min(max_items, len(self.items))
+            callback(Result(value=[self.items.popleft() for _ in range(count)]))
+        else:
+            callback(Result(exc=QueueClosed()))
+
 
 def producer(q, count):
     def _run(n):
@@ -114,7 +174,8 @@ def consumer(q):
     q.get(callback=_consume)
 
 
-q = AsyncQueue()
-sched.call_soon(lambda: producer(q, 10))
-sched.call_soon(lambda: consumer(q, ))
-sched.run()
+if __name__ == '__main__':
+    q = AsyncQueue()
+    sched.call_soon(lambda: producer(q, 10))
+    sched.call_soon(lambda: consumer(q, ))
+    sched.run()
@@ -37,22 +37,28 @@ class Scheduler:
         self.ready.append(coro)
 
     def run(self):
+        # One tick at a time: due timers join the ready queue, then every
+        # task ready at that point takes one step. A task that keeps
+        # yielding goes to the back and can't hold back the sleepers.
         while self.ready or self.sleeping:
             if not self.ready:             # time management exactly like the callback example.
-                deadline, _, coro = heapq.heappop(self.sleeping)
-                delta = deadline - time.time()
+                delta = self.sleeping[0][0] - time.time()
                 if delta > 0:
                     time.sleep(delta)
+            now = time.time()
+            while self.sleeping and self.sleeping[0][0] <= now:
+                deadline, _, coro = heapq.heappop(self.sleeping)
                 self.ready.append(coro)
 
-            self.current = self.ready.popleft()
-            # Drive as a generator
-            try:
-                self.current.send(None)   # next(self.current)  # Together with yield this replaces callbacks in driving the code
-                if self.current:
-                    self.ready.append(self.current)
-            except StopIteration:
-                pass
+            for _ in range(len(self.ready)):
+                self.current = self.ready.popleft()
+                # Drive as a generator
+                try:
+                    self.current.send(None)   # next(self.current)  # Together with yield this replaces callbacks in driving the code
+                    if self.current:
+                        self.ready.append(self.current)
+                except StopIteration:
+                    pass
 
 
 sched = Scheduler()  # Background scheduler object
@@ -65,21 +71,42 @@ class QueueClosed(Exception):
 
 
 class AsyncQueue:
-    def __init__(self):
+    def __init__(self, maxsize=0):
         self.items = deque()
-        self.waiting = deque()
+        self.waiting = deque()      # Getters waiting for an item
+        self.putting = deque()      # Putters waiting for space
+        self.maxsize = maxsize      # 0 means unbounded
+        self.high_water = 0         # Largest qsize() seen so far
         self._closed = False
 
+    def qsize(self):
+        return len(self.items)
+
+    def full(self):
+        return 0 < self.maxsize <= len(self.items)
+
     def close(self):
         self._closed = True
         if self.waiting and not self.items:
             sched.ready.append(self.waiting.popleft())  # Reschedule waiting tasks
+        while self.putting:
+            sched.ready.append(self.putting.popleft())  # They'll see QueueClosed
 
     async def put(self, item):
         if self._closed:
             raise QueueClosed()
 
+        while self.maxsize and len(self.items) >= self.maxsize:
+            # Full: wait for a getter to make room
+            self.putting.append(sched.current)
+            sched.current = None
+            await switch()
+            if self._closed:
+                raise QueueClosed()
+
         self.items.append(item)
+        if len(self.items) > self.high_water:
+            self.high_water = len(self.items)
         if self.waiting:
             sched.ready.append(self.waiting.popleft())
 
@@ -92,7 +119,10 @@ class AsyncQueue:
             sched.current = None     #
             await switch()           # Switch to another task
 
-        return self.items.popleft()
+        item = self.items.popleft()
+        if self.putting:
+            sched.ready.append(self.putting.popleft())  # Room for one more
+        return item
 
 
 async def producer(q, count):
@@ -117,10 +147,11 @@ async def consumer(q):
         print('Consumer done')
 
 
-q = AsyncQueue()
-sched.new_task(producer(q, 10))
-sched.new_task(consumer(q))
-sched.run()
+if __name__ == '__main__':
+    q = AsyncQueue()
+    sched.new_task(producer(q, 10))
+    sched.new_task(consumer(q))
+    sched.run()
 
 
 
@@ -5,6 +5,7 @@
 
 
 import time
+import types
 from collections import deque
 import heapq
 
@@ -26,22 +27,30 @@ class Scheduler:
         heapq.heappush(self.sleeping, (deadline, self.sequence, func))
 
     def run(self):
+        # One tick at a time: timers that are due join the ready queue, then
+        # only the callbacks ready at that point run. Ones they add wait for
+        # the next tick, so a task that keeps rescheduling itself can't hold
+        # back the timers.
         while self.ready or self.sleeping:
             if not self.ready:
                 # Find the nearest deadline
-                deadline, _, func = heapq.heappop(self.sleeping)
-                delta = deadline - time.time()
+                delta = self.sleeping[0][0] - time.time()
                 if delta > 0:
                     time.sleep(delta)
+            now = time.time()
+            while self.sleeping and self.sleeping[0][0] <= now:
+                deadline, _, func = heapq.heappop(self.sleeping)
                 self.ready.append(func)
 
-            while self.ready:
-                func = self.ready.popleft()
+            ready = self.ready
+            popleft = ready.popleft
+            for _ in range(len(ready)):
+                func = popleft()
                 func()
 
     # Coroutine-based functions
     def new_task(self, coro):
-        self.ready.append(Task(coro))   # Wrapped coroutine
+        self.ready.append(Task(coro, self))   # Wrapped coroutine
 
     async def sleep(self, delay):
         self.call_later(delay, self.current)
@@ -50,47 +59,69 @@ class Scheduler:
 
 # Class that wraps a coroutine--making it look like a callback
 class Task:
-    def __init__(self, coro):
+    __slots__ = ('coro', 'sched', 'send')
+
+    def __init__(self, coro, sched):
         self.coro = coro        # "Wrapped coroutine"
+        self.sched = sched      # Scheduler that runs it
+        self.send = coro.send
 
     # Make it look like a callback
     def __call__(self):
+        # Driving the coroutine as before
+        sched = self.sched
+        sched.current = self
         try:
-            # Driving the coroutine as before
-            sched.current = self
-            self.coro.send(None)
-            if sched.current:
-                sched.ready.append(self)
+            self.send(None)
         except StopIteration:
-            pass
-
-class Awaitable:
-    def __await__(self):
-        yield
+            return
+        if sched.current is not None:
+            sched.ready.append(self)
 
+# Task switch: a generator-based coroutine is awaited without creating an
+# Awaitable object or calling back into __await__
+@types.coroutine
 def switch():
-    return Awaitable()
+    yield
 
 sched = Scheduler()    # Background scheduler object
 
 # ----------------
 
 class AsyncQueue:
-    def __init__(self):
+    def __init__(self, maxsize=0):
         self.items = deque()
-        self.waiting = deque()
+        self.waiting = deque()      # Getters waiting for an item
+        self.putting = deque()      # Putters waiting for space
+        self.maxsize = maxsize      # 0 means unbounded
+        self.high_water = 0         # Largest qsize() seen so far
+
+    def qsize(self):
+        return len(self.items)
+
+    def full(self):
+        return 0 < self.maxsize <= len(self.items)
 
     async def put(self, item):
+        while self.maxsize and len(self.items) >= self.maxsize:
+            self.putting.append(sched.current)   # Wait for a getter to make room
+            sched.current = None
+            await switch()
         self.items.append(item)
+        if len(self.items) > self.high_water:
+            self.high_water = len(self.items)
         if self.waiting:
             sched.ready.append(self.waiting.popleft())
 
     async def get(self):
-        if not self.items:
+        while not self.items:
             self.waiting.append(sched.current)   # Put myself to sleep
             sched.current = None        # "Disappear"
             await switch()              # Switch to another task
-        return self.items.popleft()
+        item = self.items.popleft()
+        if self.putting:
+            sched.ready.append(self.putting.popleft())   # Room for one more
+        return item
 
 # Coroutine-based tasks
 async def producer(q, count):
@@ -110,10 +141,6 @@ async def consumer(q):
         print('Consuming', item)
     print('Consumer done')
 
-q = AsyncQueue()
-sched.new_task(producer(q, 10))
-sched.new_task(consumer(q))
-
 # Call-back based tasks
 def countdown(n):
     if n > 0:
@@ -130,6 +157,10 @@ def countup(stop):
     _run(0)
 
 
-sched.call_soon(lambda: countdown(5))
-sched.call_soon(lambda: countup(20))
-sched.run()
+if __name__ == '__main__':
+    q = AsyncQueue()
+    sched.new_task(producer(q, 10))
+    sched.new_task(consumer(q))
+    sched.call_soon(lambda: countdown(5))
+    sched.call_soon(lambda: countup(20))
+    sched.run()
@@ -4,123 +4,1069 @@
 # on top of a callback-based scheduler.
 
 
+import errno
+import os
+import struct
 import time
+import types
 from collections import deque
-import heapq
-from select import select
+from itertools import islice
+from socket import SOL_SOCKET, SO_ERROR
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from pollers import default_poller, EVENT_READ, EVENT_WRITE
+from timers import TimerHandle, TimerQueue
+from loop_metrics import LoopMetrics, describe, log
+from buffer_pool import ReadBuffer
+
+# Priority lanes for call_soon()/new_task()
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+
 
 # Callback based scheduler (from earlier)
 class Scheduler:
-    def __init__(self):
+    def __init__(self, poller=None, clock=None):
         self.ready = deque()  # Functions ready to execute
         self.current = None
-        self.sleeping = []       # Sleeping functions
-        self.sequence = 0
-        self._read_waiting = {}
-        self._write_waiting = {}
+        # Time source for timers and deadlines (time.monotonic by default).
+        # A clock with an advance_to() method (timers.VirtualClock) makes this
+        # a simulated-time scheduler: whenever nothing is ready, run() only
+        # takes a non-blocking look at I/O and then jumps the clock straight
+        # to the next timer deadline instead of sleeping until it.
+        self.clock = clock if clock is not None else time.monotonic
+        self._advance_to = getattr(clock, 'advance_to', None)
+        self.sleeping = TimerQueue(self.clock)   # Sleeping functions (heap + timing wheel)
+        # I/O readiness backend (epoll, or a selectors fallback). Interest stays
+        # registered in the kernel; only fds listed in _changed get re-synced.
+        self._poller = poller if poller is not None else default_poller()
+        self._fds = {}           # fd -> _FdInterest (waiters + registration)
+        # fds whose waiters changed since the last poll. A dict used as an
+        # ordered set: fds get registered in the order their interest changed,
+        # not in fd-number order (ReplayPoller relies on it)
+        self._changed = {}
+        self._io_waiting = 0     # Waiters and watchers across all fds
+        # recv/send/accept try the syscall before waiting for readiness. A task
+        # whose I/O keeps succeeding right away never suspends, so after
+        # io_budget fast-path calls in a row it is sent through the poller once
+        # (letting everyone else run). None: no limit, 0: always wait first.
+        # Pollers that record or replay a run's I/O (pollers.py) turn the
+        # fast path off: a call that never reaches poll() isn't in the log.
+        self.io_budget = 32 if getattr(self._poller, 'io_fast_path', True) else 0
+        # Callbacks run per tick before I/O is polled again (None: all that
+        # were ready when the tick started)
+        self.max_callbacks_per_tick = None
+        # Priority lanes (see call_soon). self.ready is the PRIORITY_NORMAL
+        # lane and where every wakeup lands first. lane_weights: callbacks
+        # each lane gets per round of the weighted round-robin.
+        self.lanes = [deque(), self.ready, deque()]
+        self.lane_weights = [8, 4, 1]
+        self._lanes_used = False
+        self.metrics = None      # LoopMetrics while enabled (see enable_metrics)
+        self.tracer = None       # tracing.Tracer while tracing is on
+        # Blocking calls offloaded to threads (see run_in_executor). Finished
+        # calls are handed back through _threadsafe and the waker fd.
+        self.executor_workers = 8
+        self._executor = None
+        self._executor_pending = 0
+        # CPU-bound calls offloaded to processes (see run_in_process)
+        self.process_workers = os.cpu_count() or 1
+        self.process_batch_size = 256
+        self._process_pool = None
+        self._process_batch = None
+        self._threadsafe = deque()
+        self._waker = None       # _Waker, opened by the first executor call
 
-    def call_soon(self, func):
-        self.ready.append(func)
+    def call_soon(self, func, priority=PRIORITY_NORMAL):
+        # priority picks the lane: PRIORITY_HIGH for latency-sensitive work,
+        # PRIORITY_LOW for bulk/background work. Lanes are served by weighted
+        # round-robin, so low priority work is slowed down, never starved.
+        if priority == PRIORITY_NORMAL:
+            self.ready.append(func)
+        else:
+            self._lanes_used = True
+            self.lanes[priority].append(func)
 
-    def call_later(self, delay, func):
-        self.sequence += 1
-        deadline = time.time() + delay     # Expiration time
-        # Priority queue
-        heapq.heappush(self.sleeping, (deadline, self.sequence, func))
+    def call_later(self, delay, func, coarse=False):
+        # Returns a TimerHandle; handle.cancel() takes the timer back out.
+        # coarse=True is meant for timeouts: it goes on the timing wheel
+        # (O(1) insert/cancel) and fires within one wheel tick of its deadline.
+        deadline = self.clock() + delay     # Expiration time
+        return self.sleeping.call_at(deadline, func, coarse)
+
+    def _interest(self, fileno):
+        fd = _fd(fileno)
+        interest = self._fds.get(fd)
+        if interest is None:
+            interest = self._fds[fd] = _FdInterest(fd)
+        return interest
 
     def read_wait(self, fileno, func):
-        # Trigger func() when fileno is readable
-        self._read_waiting[fileno] = func
+        # Trigger func() once, the next time fileno is readable. Several
+        # waiters can queue on one fd; they're woken one per event, FIFO.
+        interest = self._interest(fileno)
+        interest.readers.append(func)
+        self._io_waiting += 1
+        if not interest.registered & EVENT_READ:
+            self._changed[interest.fd] = None
+        return interest
 
     def write_wait(self, fileno, func):
-        # Trigger func() while fileno is writeable
-        self._write_waiting[fileno] = func
+        # Trigger func() once, the next time fileno is writeable
+        interest = self._interest(fileno)
+        interest.writers.append(func)
+        self._io_waiting += 1
+        if not interest.registered & EVENT_WRITE:
+            self._changed[interest.fd] = None
+        return interest
+
+    def add_reader(self, fileno, func, edge=False):
+        # Persistent watch: func() runs on every readiness event until
+        # remove_reader(). Level-triggered by default (every tick while
+        # readable). With edge=True it runs once per new arrival instead, so
+        # func must read until BlockingIOError. Edge mode needs epoll; other
+        # pollers fall back to level-triggered.
+        interest = self._interest(fileno)
+        if interest.on_readable is None:
+            self._io_waiting += 1
+        interest.on_readable = func
+        self._set_edge(interest, edge)
+        self._changed[interest.fd] = None
+
+    def add_writer(self, fileno, func, edge=False):
+        interest = self._interest(fileno)
+        if interest.on_writable is None:
+            self._io_waiting += 1
+        interest.on_writable = func
+        self._set_edge(interest, edge)
+        self._changed[interest.fd] = None
+
+    def remove_reader(self, fileno):
+        interest = self._fds.get(_fd(fileno))
+        if interest is not None and interest.on_readable is not None:
+            interest.on_readable = None
+            self._io_waiting -= 1
+            self._changed[interest.fd] = None
+
+    def remove_writer(self, fileno):
+        interest = self._fds.get(_fd(fileno))
+        if interest is not None and interest.on_writable is not None:
+            interest.on_writable = None
+            self._io_waiting -= 1
+            self._changed[interest.fd] = None
+
+    def _set_edge(self, interest, edge):
+        if interest.edge != edge:
+            interest.edge = edge
+            if interest.registered:
+                interest.registered = _REREGISTER
+
+    def _call_soon_threadsafe(self, func):
+        # From another thread: queue func and kick the loop out of poll().
+        # The loop only listens to the waker while executor calls are pending.
+        self._threadsafe.append(func)
+        self._waker.wake()
+
+    def _wakeup(self):
+        # Waker fd became readable: pick up what other threads handed over
+        self._waker.drain()
+        while self._threadsafe:
+            self.ready.append(self._threadsafe.popleft())
+
+    def _executor_started(self):
+        if not self._executor_pending:
+            if self._waker is None:
+                self._waker = _Waker()
+            self.add_reader(self._waker, self._wakeup)
+        self._executor_pending += 1
+
+    def _executor_finished(self):
+        self._executor_pending -= 1
+        if not self._executor_pending:
+            # Nothing left in flight: stop listening so run() can finish
+            self.remove_reader(self._waker)
+
+    async def _wait_future(self, future):
+        # Park the current task until a concurrent.futures.Future completes.
+        # It waits in a one-task deque, so cancel() (and wait_for()) can take
+        # it out right away; the call's result is then dropped when it comes.
+        parked = deque([self.current])
+        self.current.waiting_on = parked
+
+        def _done():
+            self._executor_finished()
+            if parked:                          # Not cancelled meanwhile
+                self.ready.append(parked.popleft())
+
+        self._executor_started()
+        future.add_done_callback(lambda f: self._call_soon_threadsafe(_done))
+        self.current = None
+        try:
+            await switch()
+        except CancelledError:
+            future.cancel()     # Only stops a call that hasn't started yet
+            raise
+        return future.result()
+
+    async def run_in_executor(self, func, *args):
+        # Run a blocking call on a bounded thread pool. Only the calling task
+        # waits; the rest of the Scheduler keeps running.
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(self.executor_workers)
+        return await self._wait_future(self._executor.submit(func, *args))
+
+    async def run_in_process(self, func, *args):
+        # Run a CPU-bound call on a process pool. func, args and the result
+        # must be picklable. Calls made during the same tick are collected
+        # and shipped as a few batches (one per worker process at most), so
+        # a fan-out of many small calls costs a few pickle round trips, not
+        # one per call.
+        batch = self._process_batch
+        if batch is None:
+            batch = self._process_batch = _ProcessBatch()
+            self.call_soon(self._flush_process_batch)
+        index = len(batch.calls)
+        batch.calls.append((func, args))
+        parked = deque([self.current])      # (see _wait_future)
+        self.current.waiting_on = parked
+        batch.tasks.append(parked)
+        if len(batch.calls) >= self.process_batch_size:
+            self._flush_process_batch()
+        self.current = None
+        await switch()
+        ok, value = batch.results[index]
+        if not ok:
+            raise value
+        return value
+
+    def _flush_process_batch(self):
+        batch = self._process_batch
+        if batch is None:
+            return
+        self._process_batch = None
+        if self._process_pool is None:
+            self._process_pool = ProcessPoolExecutor(self.process_workers)
+        calls = batch.calls
+        batch.results = [None] * len(calls)
+        # Split into contiguous chunks so the batch still spreads over cores
+        size = -(-len(calls) // self.process_workers)
+        for start in range(0, len(calls), size):
+            self._executor_started()
+            future = self._process_pool.submit(_run_batch, calls[start:start + size])
+            future.add_done_callback(
+                lambda f, start=start: self._call_soon_threadsafe(
+                    lambda: self._process_chunk_done(batch, start, f)))
+
+    def _process_chunk_done(self, batch, start, future):
+        try:
+            results = future.result()
+        except BaseException as e:          # Pickling error, dead worker...
+            count = min(len(batch.calls) - start, -(-len(batch.calls) // self.process_workers))
+            results = [(False, e)] * count
+        batch.results[start:start + len(results)] = results
+        for parked in batch.tasks[start:start + len(results)]:
+            if parked:                          # Not cancelled meanwhile
+                self.ready.append(parked.popleft())
+        self._executor_finished()
+
+    def forget(self, fileno):
+        # Drop every wait and the poller registration for fileno. Must be
+        # called before the fd is closed: the kernel reuses fd numbers, and a
+        # registration left behind would be mistaken for the new socket's.
+        # Tasks suspended on the fd are woken with OSError(EBADF) instead of
+        # being left waiting forever; plain callbacks and watchers are dropped.
+        fd = _fd(fileno)
+        interest = self._fds.pop(fd, None)
+        if interest is None:
+            return
+        self._changed.pop(fd, None)
+        for waiters in (interest.readers, interest.writers):
+            for waiter in waiters:
+                if isinstance(waiter, Task):
+                    waiter.waiting_on = None
+                    waiter._raise_later(OSError(errno.EBADF, 'fd %d was closed while '
+                                                'a task was waiting on it' % fd))
+                    self.ready.append(waiter)
+        self._io_waiting -= (len(interest.readers) + len(interest.writers) +
+                             (interest.on_readable is not None) +
+                             (interest.on_writable is not None))
+        if interest.registered:
+            try:
+                self._poller.unregister(fd)
+            except (OSError, KeyError, ValueError):
+                pass
+
+    def close(self, sock):
+        self.forget(sock)
+        sock.close()
+
+    def shutdown(self):
+        # Release what the Scheduler itself holds: the poller, the waker fds
+        # and the executor pools. Call it once run() is finished with a
+        # Scheduler that isn't going to be used again.
+        if self._poller is None:
+            return
+        if self._waker is not None:
+            self.forget(self._waker)
+            self._waker.close()
+            self._waker = None
+        self._poller.close()
+        self._poller = None
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+        if self._process_pool is not None:
+            self._process_pool.shutdown()
+            self._process_pool = None
+
+    def _unwait(self, task):
+        # Take a suspended task out of what it is waiting on (task.waiting_on:
+        # an fd's interest record, its sleep() timer or a deque of waiters).
+        # False if it isn't there any more: it was woken and is about to run.
+        where = task.waiting_on
+        task.waiting_on = None
+        if type(where) is _FdInterest:
+            for waiters in (where.readers, where.writers):
+                try:
+                    waiters.remove(task)
+                except ValueError:
+                    continue
+                if self._fds.get(where.fd) is where:     # Not forget()-ten
+                    self._io_waiting -= 1
+                    if not waiters:
+                        self._changed[where.fd] = None
+                return True
+            return False
+        if type(where) is TimerHandle:
+            if not where.pending():
+                return False
+            where.cancel()
+            return True
+        try:
+            where.remove(task)
+        except ValueError:
+            return False
+        return True
+
+    def _sync_registrations(self):
+        # Make the poller's interest match the waiters. A task that is woken
+        # and waits on the same fd again before the next poll (the usual
+        # recv() loop) leaves its registration untouched: no system call.
+        # An fd nobody is waiting on any more is unregistered and forgotten.
+        for fd in self._changed:
+            interest = self._fds.get(fd)
+            if interest is None:
+                continue
+            events = interest.events()
+            registered = interest.registered
+            if not events:
+                del self._fds[fd]
+                if registered:
+                    try:
+                        self._poller.unregister(fd)
+                    except (OSError, KeyError, ValueError):
+                        pass        # Already closed (the kernel dropped it)
+                continue
+            if events == registered:
+                continue
+            if registered:
+                try:
+                    self._poller.modify(fd, events, interest.edge)
+                except (OSError, KeyError):
+                    # fd was closed and its number reused by a new socket
+                    self._poller.register(fd, events, interest.edge)
+            else:
+                try:
+                    self._poller.register(fd, events, interest.edge)
+                except FileExistsError:
+                    self._poller.modify(fd, events, interest.edge)
+            interest.registered = events
+        self._changed.clear()
+
+    def enable_metrics(self, slow_callback=0.1):
+        # Start collecting loop statistics; read them with .snapshot()
+        self.metrics = LoopMetrics(slow_callback)
+        return self.metrics
+
+    def disable_metrics(self):
+        if self.metrics is not None:
+            self.metrics.stop_reporter()
+        self.metrics = None
 
     def run(self):
-        while self.ready or self.sleeping or self._read_waiting or self._write_waiting:
-            if not self.ready:
+        # Every trip round this loop is one tick: poll for I/O, move due
+        # timers onto the ready queue, then run the callbacks that are ready
+        # at that point (at most max_callbacks_per_tick of them). Anything
+        # queued while they run waits for the next tick, after the next poll,
+        # so a task that keeps rescheduling itself can't starve I/O or timers.
+        ready = self.ready
+        popleft = ready.popleft
+        sleeping = self.sleeping
+        clock = self.clock
+        while ready or sleeping or self._io_waiting or (self._lanes_used and any(self.lanes)):
+            metrics = self.metrics
+            if metrics is not None:
+                metrics.tick_started(self)
+            jump = None               # Virtual time: deadline to move the clock to
+            if ready or (self._lanes_used and any(self.lanes)):
+                timeout = 0           # Just look, callbacks are waiting
+            else:
                 # Find the nearest deadline
-                if self.sleeping:
-                    deadline, _, func = self.sleeping[0]
-                    timeout = deadline - time.time()
+                deadline = sleeping.next_deadline()
+                if deadline is None:
+                    timeout = None    # Wait forever
+                else:
+                    timeout = deadline - clock()
                     if timeout < 0:
                         timeout = 0
+                    if self._advance_to is not None:
+                        # Virtual time: don't wait for the deadline, jump to
+                        # it. Only I/O that is ready right now comes first
+                        # (unless the poller replays I/O on this same clock).
+                        jump = deadline
+                        if not getattr(self._poller, 'advances_clock', False):
+                            timeout = 0
+            # Wait for I/O (and sleep). Nothing to look at if no fd is
+            # watched and there are callbacks to run.
+            if timeout != 0 or self._io_waiting:
+                if self._changed:
+                    self._sync_registrations()
+                if metrics is None:
+                    ready_fds = self._poller.poll(timeout)
                 else:
-                    timeout = None    # Wait forever
-                # Wait for I/O (and sleep)
-                can_read, can_write, _ = select(self._read_waiting,
-                                                self._write_waiting, [], timeout)
-
-                for file_descriptor in can_read:
-                    self.ready.append(self._read_waiting.pop(file_descriptor))
-
-                for file_descriptor in can_write:
-                    self.ready.append(self._write_waiting.pop(file_descriptor))
-
-                # Check for sleeping tasks
-                now = time.time()
-                while self.sleeping:
-                    if now > self.sleeping[0][0]:
-                        self.ready.append(heapq.heappop(self.sleeping[2]))
-                    else:
-                        break
-
-            while self.ready:
-                func = self.ready.popleft()
+                    start = time.perf_counter()
+                    ready_fds = self._poller.poll(timeout)
+                    metrics.poll_time += time.perf_counter() - start
+                if jump is not None and not ready_fds:
+                    self._advance_to(jump)      # Nothing came in before the timer
+                for fd, events in ready_fds:
+                    interest = self._fds.get(fd)
+                    if interest is None:
+                        continue
+                    if events & EVENT_READ:
+                        if interest.readers:
+                            self.ready.append(interest.readers.popleft())
+                            self._io_waiting -= 1
+                            if not interest.readers:
+                                self._changed[fd] = None
+                        if interest.on_readable is not None:
+                            self.ready.append(interest.on_readable)
+                    if events & EVENT_WRITE:
+                        if interest.writers:
+                            self.ready.append(interest.writers.popleft())
+                            self._io_waiting -= 1
+                            if not interest.writers:
+                                self._changed[fd] = None
+                        if interest.on_writable is not None:
+                            self.ready.append(interest.on_writable)
+            elif jump is not None:
+                self._advance_to(jump)
+
+            # Check for sleeping tasks
+            if sleeping:
+                if metrics is None:
+                    sleeping.expire(clock(), ready)
+                else:
+                    now = clock()
+                    fired = []
+                    sleeping.expire(now, fired)
+                    metrics.timers_fired(now, fired)
+                    ready.extend(fired)
+
+            if self._lanes_used:
+                self._route()
+                self._run_lanes(metrics)
+                continue
+            count = len(ready)
+            limit = self.max_callbacks_per_tick
+            if limit is not None and count > limit:
+                count = limit
+            if self.tracer is not None:
+                self.tracer.run_ready(ready, count)    # Times every task step
+                continue
+            if metrics is not None:
+                metrics.run_ready(ready, count)
+                continue
+            while count:
+                func = popleft()
                 func()
+                count -= 1
+
+    def _route(self):
+        # Wakeups all land in self.ready. Move tasks (and timers that wake
+        # them) whose priority says otherwise over to their own lane.
+        ready = self.ready
+        lanes = self.lanes
+        for _ in range(len(ready)):
+            func = ready.popleft()
+            target = func.func if type(func) is TimerHandle else func
+            lanes[getattr(target, 'priority', PRIORITY_NORMAL)].append(func)
+
+    def _run_lanes(self, metrics):
+        # Weighted round-robin over what each lane held when the tick
+        # started, up to max_callbacks_per_tick in total
+        lanes = self.lanes
+        weights = self.lane_weights
+        counts = [len(lane) for lane in lanes]
+        if metrics is not None:
+            metrics.lanes_started(counts)
+        total = sum(counts)
+        limit = self.max_callbacks_per_tick
+        if limit is not None and total > limit:
+            total = limit
+        tracer = self.tracer
+        while total:
+            for priority, lane in enumerate(lanes):
+                count = min(weights[priority], counts[priority], total)
+                if not count:
+                    continue
+                counts[priority] -= count
+                total -= count
+                if tracer is not None:
+                    tracer.run_ready(lane, count, priority)
+                    continue
+                if metrics is not None:
+                    metrics.run_ready(lane, count, priority)
+                    continue
+                popleft = lane.popleft
+                while count:
+                    func = popleft()
+                    func()
+                    count -= 1
 
     # Coroutine-based functions
-    def new_task(self, coro):
-        self.ready.append(Task(coro))   # Wrapped coroutine
+    def create_future(self):
+        return Future(self)
+
+    def new_task(self, coro, priority=PRIORITY_NORMAL):
+        # Returns the Task: `await task` for its result, task.cancel() to stop it
+        task = Task(coro, self)   # Wrapped coroutine
+        if self.tracer is not None:
+            self.tracer.task_created(task)      # Remember where it came from
+        task.priority = priority
+        self.call_soon(task, priority)
+        return task
 
     async def sleep(self, delay):
-        self.call_later(delay, self.current)
+        task = self.current
+        task.waiting_on = self.call_later(delay, task)
         self.current = None
         await switch()   # Switch to a new task
 
+    async def wait_for(self, aw, timeout):
+        # Run a coroutine (or wait for a Task/Future) for at most `timeout` seconds.
+        # When time is up it is cancelled and TimeoutError raised here. The
+        # limit becomes the child's deadline, which its I/O calls check
+        # before doing anything (see _try_now), so work that's already too
+        # late is dropped instead of finished. Deadlines never grow: a
+        # wait_for() inside another keeps the earlier of the two, and with
+        # timeout=None the caller's deadline (if any) is passed on as is.
+        parent = self.current
+        task = aw if isinstance(aw, Future) else self.new_task(aw, parent.priority)
+        deadline = parent.deadline
+        if timeout is not None:
+            expires = self.clock() + timeout
+            if deadline is None or expires < deadline:
+                deadline = expires
+        if deadline is None:
+            return await task
+        if isinstance(task, Task) and (task.deadline is None or deadline < task.deadline):
+            task.deadline = deadline
+        expired = []
+
+        def _expire():
+            if not task.done():
+                expired.append(True)
+                task.cancel()
+
+        # A timeout: on the timing wheel (O(1) add/cancel, up to one tick late)
+        timer = self.call_later(deadline - self.clock(), _expire, coarse=True)
+        try:
+            return await task
+        except CancelledError:
+            if expired:
+                raise TimeoutError('timed out') from None
+            task.cancel()           # We were cancelled: take the child along
+            raise
+        finally:
+            timer.cancel()
+
+    async def gather(self, *aws, limit=None, return_exceptions=False):
+        # Run coroutines (or wait for Tasks/Futures) concurrently, no more
+        # than `limit` at a time, and return their results in argument
+        # order. This task sleeps until the last one is done. The first
+        # exception cancels the rest and is raised here, unless
+        # return_exceptions=True puts the exceptions in the list instead.
+        group = _Completion(self, aws, limit, False, not return_exceptions)
+        group.start()
+        try:
+            while group.remaining and group.failed is None:
+                await group.wait()
+        finally:
+            if group.remaining:
+                group.stop()
+        if group.failed is not None:
+            return group.failed.result()        # Raises its exception
+        return [task.exception() or task.result() for task in group.tasks]
+
+    async def as_completed(self, aws, limit=None):
+        # async for task in sched.as_completed(coros): the Tasks in the
+        # order they finish (task.result() to get the value), no more than
+        # `limit` running at a time. Leaving the loop early cancels the rest.
+        group = _Completion(self, list(aws), limit, True, False)
+        group.start()
+        try:
+            while group.finished or group.remaining:
+                if group.finished:
+                    yield group.finished.popleft()
+                else:
+                    await group.wait()
+        finally:
+            if group.remaining:
+                group.stop()
+
+    # Socket I/O. The socket is switched to non-blocking mode and the call is
+    # tried straight away; only if the kernel has nothing for us
+    # (BlockingIOError) does the task wait for the poller.
+    def _try_now(self, sock):
+        if sock.getblocking():
+            sock.setblocking(False)
+        task = self.current
+        if task.deadline is not None and self.clock() >= task.deadline:
+            raise TimeoutError('deadline exceeded before I/O')
+        budget = self.io_budget
+        if budget is None or task.io_streak < budget:
+            task.io_streak += 1
+            return True
+        return False            # Out of budget: go through the poller this time
+
+    async def _when_ready(self, wait, sock, call, *args):
+        # Slow path: suspend until sock is ready, then retry the call
+        while True:
+            task = self.current
+            task.io_streak = 0
+            task.waiting_on = wait(sock, task)
+            self.current = None
+            await switch()
+            try:
+                return call(*args)
+            except BlockingIOError:
+                pass            # Another waiter got there first; wait again
+
     async def recv(self, sock, maxbytes):
-        self.read_wait(sock, self.current)
-        self.current = None
-        await switch()
-        return sock.recv(maxbytes)
+        if self._try_now(sock):
+            try:
+                return sock.recv(maxbytes)
+            except BlockingIOError:
+                pass
+        return await self._when_ready(self.read_wait, sock, sock.recv, maxbytes)
+
+    async def recv_into(self, sock, buf, nbytes=0):
+        # Read into a caller-owned buffer (bytearray/memoryview) instead of
+        # allocating a new bytes object. Returns the number of bytes read.
+        if self._try_now(sock):
+            try:
+                return sock.recv_into(buf, nbytes)
+            except BlockingIOError:
+                pass
+        return await self._when_ready(self.read_wait, sock, sock.recv_into, buf, nbytes)
 
     async def send(self, sock, data):
-        self.write_wait(sock, self.current)
-        self.current = None
-        await switch()
-        return sock.send(data)
+        if self._try_now(sock):
+            try:
+                return sock.send(data)
+            except BlockingIOError:
+                pass
+        return await self._when_ready(self.write_wait, sock, sock.send, data)
+
+    async def sendall(self, sock, data):
+        # send() may take only part of the data; keep going until it's all out
+        view = memoryview(data).cast('B')
+        while view:
+            if self._try_now(sock):
+                try:
+                    view = view[sock.send(view):]
+                    continue
+                except BlockingIOError:
+                    pass
+            view = view[await self._when_ready(self.write_wait, sock, sock.send, view):]
 
     async def accept(self, sock):
-        self.read_wait(sock, self.current)
-        self.current = None
+        if self._try_now(sock):
+            try:
+                client, addr = sock.accept()
+                client.setblocking(False)
+                return client, addr
+            except BlockingIOError:
+                pass
+        client, addr = await self._when_ready(self.read_wait, sock, sock.accept)
+        client.setblocking(False)
+        return client, addr
+
+    async def connect(self, sock, addr):
+        # Start the connection, then wait for writeable (= connected or failed)
+        sock.setblocking(False)
+        err = sock.connect_ex(addr)
+        if err in (errno.EINPROGRESS, errno.EAGAIN, errno.EALREADY):
+            task = self.current
+            task.waiting_on = self.write_wait(sock, task)
+            self.current = None
+            await switch()
+            err = sock.getsockopt(SOL_SOCKET, SO_ERROR)
+        if err and err != errno.EISCONN:
+            raise OSError(err, os.strerror(err))
+
+
+_REREGISTER = -1      # _FdInterest.registered: edge mode changed, modify() it
+
+
+class _FdInterest:
+    # Everything the Scheduler knows about one file descriptor
+    __slots__ = ('fd', 'readers', 'writers', 'on_readable', 'on_writable',
+                 'edge', 'registered')
+
+    def __init__(self, fd):
+        self.fd = fd
+        self.readers = deque()      # One-shot read_wait() callbacks
+        self.writers = deque()      # One-shot write_wait() callbacks
+        self.on_readable = None     # Persistent add_reader() callback
+        self.on_writable = None     # Persistent add_writer() callback
+        self.edge = False           # Edge-triggered registration
+        self.registered = 0         # Events registered with the poller
+
+    def events(self):
+        events = 0
+        if self.readers or self.on_readable is not None:
+            events |= EVENT_READ
+        if self.writers or self.on_writable is not None:
+            events |= EVENT_WRITE
+        return events
+
+
+class _ProcessBatch:
+    __slots__ = ('calls', 'tasks', 'results')
+
+    def __init__(self):
+        self.calls = []         # (func, args)
+        self.tasks = []         # Task waiting on the call at the same index (in a deque)
+        self.results = None     # (ok, value) per call, filled in by chunk
+
+
+class _Completion:
+    # Shared countdown behind gather() and as_completed(). Starts the
+    # awaitables (no more than `limit` running at once) as Tasks in the
+    # caller's lane, keeps the finished ones in completion order and wakes
+    # the waiting task only when there's something for it: on every finish
+    # for as_completed(), on the last one (or the first error) for gather().
+    def __init__(self, sched, aws, limit, wake_each, stop_on_error):
+        if limit is not None and limit < 1:
+            for aw in aws:
+                if not isinstance(aw, Future):
+                    aw.close()          # (no "never awaited" warning)
+            raise ValueError('limit must be at least 1 (or None), not %r' % (limit,))
+        self.sched = sched
+        self.aws = aws
+        self.limit = limit
+        self.wake_each = wake_each
+        self.stop_on_error = stop_on_error
+        self.priority = sched.current.priority
+        self.tasks = [None] * len(aws)  # Started so far, in argument order
+        self.started = 0
+        self.running = 0
+        self.remaining = len(aws)
+        self.finished = deque()         # Not yet handed out by as_completed()
+        self.failed = None              # First task with an exception
+        self.waiters = deque()
+        self._on_done = self._child_done    # One bound method for every child
+
+    def start(self):
+        aws = self.aws
+        while self.started < len(aws) and (self.limit is None or self.running < self.limit):
+            aw = aws[self.started]
+            task = aw if isinstance(aw, Future) else self.sched.new_task(aw, self.priority)
+            self.tasks[self.started] = task
+            self.started += 1
+            self.running += 1
+            task.add_done_callback(self._on_done)
+
+    def _child_done(self, task):
+        self.running -= 1
+        self.remaining -= 1
+        if self.wake_each:
+            self.finished.append(task)
+        if self.stop_on_error and self.failed is None and task._exception is not None:
+            self.failed = task
+        elif self.failed is None:
+            self.start()                # Its slot goes to the next one
+        if self.waiters and (self.wake_each or not self.remaining or self.failed is not None):
+            self.sched.ready.extend(self.waiters)
+            self.waiters.clear()
+
+    async def wait(self):
+        sched = self.sched
+        task = sched.current
+        self.waiters.append(task)
+        task.waiting_on = self.waiters
+        sched.current = None
         await switch()
-        return sock.accept()
 
+    def stop(self):
+        # Cancel what's still running and drop what never got started
+        for task in self.tasks[:self.started]:
+            task.cancel()
+        for aw in self.aws[self.started:]:
+            if not isinstance(aw, Future):
+                aw.close()              # (no "never awaited" warning)
+        self.started = len(self.aws)
+
+
+def _run_batch(calls):
+    # Runs in a worker process: the whole chunk arrives (and its results go
+    # back) in a single pickle round trip
+    results = []
+    for func, args in calls:
+        try:
+            results.append((True, func(*args)))
+        except Exception as e:
+            results.append((False, e))
+    return results
+
+
+class _Waker:
+    # Lets other threads wake a Scheduler that is blocked in poll(): an
+    # eventfd where available, otherwise a non-blocking self-pipe.
+    def __init__(self):
+        if hasattr(os, 'eventfd'):
+            self._read_fd = self._write_fd = os.eventfd(0, os.EFD_NONBLOCK | os.EFD_CLOEXEC)
+        else:
+            self._read_fd, self._write_fd = os.pipe()
+            os.set_blocking(self._read_fd, False)
+            os.set_blocking(self._write_fd, False)
+
+    def fileno(self):
+        return self._read_fd
+
+    def wake(self):
+        try:
+            if self._read_fd == self._write_fd:
+                os.eventfd_write(self._write_fd, 1)
+            else:
+                os.write(self._write_fd, b'\0')
+        except BlockingIOError:
+            pass        # Plenty of wakeups already pending
+
+    def drain(self):
+        try:
+            if self._read_fd == self._write_fd:
+                os.eventfd_read(self._read_fd)
+            else:
+                while os.read(self._read_fd, 4096):
+                    pass
+        except BlockingIOError:
+            pass
+
+    def close(self):
+        os.close(self._read_fd)
+        if self._write_fd != self._read_fd:
+            os.close(self._write_fd)
+        self._read_fd = self._write_fd = -1
+
+
+def _fd(fileno):
+    # Accept either a raw file descriptor or anything with a fileno() method
+    return fileno if isinstance(fileno, int) else fileno.fileno()
 
-# Class that wraps a coroutine--making it look like a callback
-class Task:
-    def __init__(self, coro):
+
+class CancelledError(BaseException):
+    # Thrown into a task by Task.cancel(). A BaseException, so that
+    # `except Exception` in the task doesn't swallow it by accident.
+    pass
+
+
+# A result that isn't there yet. Callback code completes it with
+# set_result()/set_exception() (a bound fut.set_result is a ready-made
+# callback); coroutines `await` it; add_done_callback() gets fn(future).
+# Completing wakes every waiting task with a single ready-queue extend()
+# and runs all done callbacks from one ready-queue entry.
+class Future:
+    __slots__ = ('sched', '_done', '_result', '_exception', '_waiters',
+                 '_callbacks', '_log_exception')
+
+    def __init__(self, sched):
+        self.sched = sched
+        self._done = False
+        self._result = None
+        self._exception = None
+        self._waiters = None    # Tasks doing `await future`
+        self._callbacks = None  # add_done_callback() functions
+        self._log_exception = False
+
+    def _finish(self, result, exc):
+        self._done = True
+        self._result = result
+        self._exception = exc
+        self._log_exception = exc is not None and not isinstance(exc, CancelledError)
+        waiters = self._waiters
+        if waiters:
+            # Empty the deque too: a woken task's waiting_on still points at
+            # it, and cancel() must not find (and requeue) the task there
+            self._waiters = None
+            self.sched.ready.extend(waiters)
+            waiters.clear()
+        if self._callbacks:
+            self.sched.ready.append(self._run_callbacks)
+
+    def _run_callbacks(self):
+        # (None: every callback was removed after this was queued)
+        callbacks, self._callbacks = self._callbacks, None
+        for func in callbacks or ():
+            func(self)
+
+    def set_result(self, value):
+        if self._done:
+            raise RuntimeError('Future is already done')
+        self._finish(value, None)
+
+    def set_exception(self, exc):
+        if self._done:
+            raise RuntimeError('Future is already done')
+        if isinstance(exc, type):
+            exc = exc()
+        self._finish(None, exc)
+
+    def cancel(self):
+        if self._done:
+            return False
+        self._finish(None, CancelledError())
+        return True
+
+    def add_done_callback(self, func):
+        # func(future) once it's done: from the ready queue, never right here
+        if self._callbacks is None:
+            self._callbacks = []
+            if self._done:
+                self.sched.ready.append(self._run_callbacks)
+        self._callbacks.append(func)
+
+    def remove_done_callback(self, func):
+        if self._callbacks and func in self._callbacks:
+            self._callbacks.remove(func)
+            if not self._callbacks:
+                # Back to "no callbacks", so the next add_done_callback()
+                # on a finished future queues _run_callbacks again
+                self._callbacks = None
+            return True
+        return False
+
+    def done(self):
+        return self._done
+
+    def cancelled(self):
+        return isinstance(self._exception, CancelledError)
+
+    def result(self):
+        if not self._done:
+            raise RuntimeError('%s is not finished' % type(self).__name__)
+        self._log_exception = False
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self):
+        if not self._done:
+            raise RuntimeError('%s is not finished' % type(self).__name__)
+        self._log_exception = False
+        return self._exception
+
+    def __await__(self):
+        # Wait for it to be done; returns the result or raises the exception
+        if not self._done:
+            sched = self.sched
+            waiter = sched.current
+            if self._waiters is None:
+                self._waiters = deque()
+            self._waiters.append(waiter)
+            waiter.waiting_on = self._waiters       # (so cancel() can find it)
+            sched.current = None
+            yield
+        return self.result()
+
+    def __del__(self):
+        # Failed, and nobody ever asked for the result: don't lose the error
+        if self._log_exception:
+            log.error('%s exception was never retrieved: %s', type(self).__name__,
+                      describe(self), exc_info=self._exception)
+
+
+# Class that wraps a coroutine--making it look like a callback. It's also
+# the Future of the coroutine's return value.
+class Task(Future):
+    __slots__ = ('coro', 'send', 'priority', 'io_streak', 'deadline',
+                 'waiting_on', '_pending')
+
+    def __init__(self, coro, sched):
+        Future.__init__(self, sched)     # sched: Scheduler that runs it
         self.coro = coro        # "Wrapped coroutine"
+        self.send = coro.send   # Swapped for _throw while a cancel is pending
+        self.priority = PRIORITY_NORMAL     # Lane it goes back to when woken
+        self.io_streak = 0      # I/O calls done without suspending (io_budget)
+        self.deadline = None    # sched.clock() limit set by wait_for()
+        self.waiting_on = None  # What it's parked in, for cancel() (see _unwait)
+        self._pending = None    # Exception to throw in at the next step
 
     # Make it look like a callback
     def __call__(self):
+        # Driving the coroutine as before
+        sched = self.sched
+        sched.current = self
+        self.waiting_on = None
         try:
-            # Driving the coroutine as before
-            sched.current = self
-            self.coro.send(None)
-            if sched.current:
-                sched.ready.append(self)
-        except StopIteration:
-            pass
+            self.send(None)
+        except StopIteration as e:
+            self._finish(e.value, None)
+            return
+        except (Exception, CancelledError) as e:
+            self._finish(None, e)
+            return
+        if sched.current is not None:
+            sched.ready.append(self)
 
+    def _throw(self, value):
+        self.send = self.coro.send
+        exc, self._pending = self._pending, None
+        return self.coro.throw(exc)
 
-class Awaitable:
-    def __await__(self):
-        yield
+    # Only the coroutine itself decides what its result is
+    def set_result(self, value):
+        raise RuntimeError('Task does not support set_result()')
 
+    def set_exception(self, exc):
+        raise RuntimeError('Task does not support set_exception()')
 
+    def cancel(self):
+        # Throw CancelledError into the task where it is suspended. If it is
+        # parked on a timer, an fd, a queue, a future or an executor call,
+        # it's taken out and woken now; otherwise the error arrives when it
+        # is next resumed. False if it already finished.
+        if self._done:
+            return False
+        self._raise_later(CancelledError())
+        if self.waiting_on is not None and self.sched._unwait(self):
+            self.sched.ready.append(self)
+        return True
+
+    def _raise_later(self, exc):
+        # exc is raised inside the coroutine when it next runs
+        self._pending = exc
+        self.send = self._throw
+
+
+# The task switch itself. A plain generator marked as a coroutine can be
+# awaited directly: the interpreter suspends and resumes it without calling
+# back into Python (no Awaitable object, no __await__ method call).
+@types.coroutine
 def switch():
-    return Awaitable()
+    yield
 
 
 sched = Scheduler()    # Background scheduler object
@@ -129,21 +1075,382 @@ sched = Scheduler()    # Background scheduler object
 
 
 class AsyncQueue:
-    def __init__(self):
+    def __init__(self, maxsize=0):
         self.items = deque()
-        self.waiting = deque()
+        self.waiting = deque()      # Getters waiting for an item
+        self.putting = deque()      # Putters waiting for space
+        self.maxsize = maxsize      # 0 means unbounded
+        self.high_water = 0         # Largest qsize() seen so far
+
+    def qsize(self):
+        return len(self.items)
+
+    def full(self):
+        return 0 < self.maxsize <= len(self.items)
 
     async def put(self, item):
+        while self.maxsize and len(self.items) >= self.maxsize:
+            task = sched.current
+            self.putting.append(task)   # Wait for a getter to make room
+            task.waiting_on = self.putting
+            sched.current = None
+            try:
+                await switch()
+            except CancelledError:
+                if self.putting and not self.full():
+                    sched.ready.append(self.putting.popleft())   # Pass the slot on
+                raise
         self.items.append(item)
+        if len(self.items) > self.high_water:
+            self.high_water = len(self.items)
         if self.waiting:
             sched.ready.append(self.waiting.popleft())
 
     async def get(self):
-        if not self.items:
-            self.waiting.append(sched.current)   # Put myself to sleep
+        while not self.items:
+            task = sched.current
+            self.waiting.append(task)   # Put myself to sleep
+            task.waiting_on = self.waiting      # (so cancel() can find it)
             sched.current = None        # "Disappear"
-            await switch()              # Switch to another task
-        return self.items.popleft()
+            try:
+                await switch()          # Switch to another task
+            except CancelledError:
+                if self.items and self.waiting:
+                    sched.ready.append(self.waiting.popleft())   # Pass the item on
+                raise
+        item = self.items.popleft()
+        if self.putting:
+            sched.ready.append(self.putting.popleft())   # Room for one more
+        return item
+
+    async def put_many(self, items):
+        # Add a whole batch, waking at most one getter per new item. Still
+        # blocks (like put) whenever a bounded queue fills up.
+        for item in items:
+            while self.maxsize and len(self.items) >= self.maxsize:
+                self._batch_added()
+                self.putting.append(sched.current)
+                sched.current.waiting_on = self.putting
+                sched.current = None
+                try:
+                    await switch()
+                except CancelledError:
+                    if self.putting and not self.full():
+                        sched.ready.append(self.putting.popleft())   # Pass the slot on
+                    raise
+            self.items.append(item)
+        self._batch_added()
+
+    def _batch_added(self):
+        if len(self.items) > self.high_water:
+            self.high_water = len(self.items)
+        for _ in range(min(len(self.waiting), len(self.items))):
+            sched.ready.append(self.waiting.popleft())
+
+    async def get_many(self, max_items, timeout=None):
+        # Wait until something is available, then take up to max_items in a
+        # single wakeup. Returns [] if timeout (seconds) runs out first.
+        expired = []
+        timer = None
+        if not self.items and timeout is not None:
+            task = sched.current
+
+            def _expire():
+                # Also when a put has already woken us: another getter may
+                # take that item before we run, and there'd be no timer left
+                expired.append(True)
+                if task in self.waiting:
+                    self.waiting.remove(task)
+                    sched.ready.append(task)
+
+            timer = sched.call_later(timeout, _expire, coarse=True)
+        try:
+            while not self.items and not expired:
+                self.waiting.append(sched.current)
+                sched.current.waiting_on = self.waiting
+                sched.current = None
+                try:
+                    await switch()
+                except CancelledError:
+                    if self.items and self.waiting:
+                        sched.ready.append(self.waiting.popleft())   # Pass the items on
+                    raise
+        finally:
+            if timer is not None:
+                timer.cancel()
+        count = min(max_items, len(self.items))
+        batch = [self.items.popleft() for _ in range(count)]
+        for _ in range(min(count, len(self.putting))):
+            sched.ready.append(self.putting.popleft())
+        return batch
+
+try:
+    IOV_MAX = os.sysconf('SC_IOV_MAX')     # Most buffers one sendmsg() takes
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 16
+
+
+class StreamWriter:
+    # Buffered writer for a socket. write() never blocks; everything written
+    # during one tick goes out as a single sendmsg() with one iovec entry per
+    # chunk, so a header and a payload are never glued together by copying.
+    # Partial sends keep the unsent tail (as a memoryview) for next time.
+    # drain() applies backpressure: it waits while more than high_water bytes
+    # are queued, until the backlog is back down to low_water.
+    def __init__(self, sock, high_water=64 * 1024, low_water=16 * 1024):
+        self.sock = sock
+        sock.setblocking(False)     # Short writes are handled here instead
+        self.high_water = high_water
+        self.low_water = low_water
+        self._buffers = deque()     # Chunks waiting to be sent (never joined)
+        self._size = 0              # Bytes waiting to be sent
+        self._flush_pending = False # A _flush is queued or waiting on write_wait
+        self._drain_waiters = deque()
+        self._flush_waiters = deque()
+        self._error = None
+
+    def buffered(self):
+        return self._size
+
+    def write(self, data):
+        if self._error:
+            raise self._error
+        size = data.nbytes if isinstance(data, memoryview) else len(data)
+        if not size:
+            return
+        self._buffers.append(data)
+        self._size += size
+        if not self._flush_pending:
+            self._flush_pending = True
+            sched.call_soon(self._flush)   # Coalesce the rest of this tick's writes
+
+    def writelines(self, chunks):
+        for chunk in chunks:
+            self.write(chunk)
+
+    def _flush(self):
+        buffers = self._buffers
+        while buffers:
+            chunks = list(islice(buffers, IOV_MAX))
+            try:
+                if hasattr(self.sock, 'sendmsg'):
+                    sent = self.sock.sendmsg(chunks)
+                else:
+                    sent = self.sock.send(b''.join(chunks))
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError as e:
+                self._fail(e)
+                return
+            self._size -= sent
+            for chunk in chunks:
+                size = chunk.nbytes if isinstance(chunk, memoryview) else len(chunk)
+                if sent < size:
+                    break
+                buffers.popleft()
+                sent -= size
+            else:
+                continue            # Took every chunk: send the next IOV_MAX
+            if sent:
+                buffers[0] = memoryview(chunk).cast('B')[sent:]
+            break                   # Short write: the kernel buffer is full
+        if buffers:
+            sched.write_wait(self.sock, self._flush)   # Kernel buffer is full
+        else:
+            self._flush_pending = False
+        self._wake()
+
+    def _wake(self):
+        if self._size <= self.low_water:
+            while self._drain_waiters:
+                sched.ready.append(self._drain_waiters.popleft())
+        if not self._size:
+            while self._flush_waiters:
+                sched.ready.append(self._flush_waiters.popleft())
+
+    def _fail(self, exc):
+        self._error = exc
+        self._buffers.clear()
+        self._size = 0
+        self._flush_pending = False
+        self._wake()
+
+    async def drain(self):
+        while self._size > self.high_water and not self._error:
+            self._drain_waiters.append(sched.current)
+            sched.current.waiting_on = self._drain_waiters
+            sched.current = None
+            await switch()
+        if self._error:
+            raise self._error
+
+    async def flush(self):
+        # Wait until everything written so far has been handed to the kernel
+        while self._size and not self._error:
+            self._flush_waiters.append(sched.current)
+            sched.current.waiting_on = self._flush_waiters
+            sched.current = None
+            await switch()
+        if self._error:
+            raise self._error
+
+    async def sendall(self, *chunks):
+        # Write the chunks (as separate iovecs) and wait until all are sent.
+        # With nothing else queued they go to the kernel right away, in one
+        # sendmsg(), instead of a tick later from _flush. Only what a short
+        # or blocked write leaves over is buffered and waited for.
+        if (not (self._size or self._flush_pending or self._error) and len(chunks) <= IOV_MAX
+                and hasattr(self.sock, 'sendmsg') and sched._try_now(self.sock)):
+            try:
+                sent = self.sock.sendmsg(chunks)
+            except (BlockingIOError, InterruptedError):
+                sent = 0
+            except OSError as e:
+                self._fail(e)
+                raise
+            for index, chunk in enumerate(chunks):
+                size = chunk.nbytes if isinstance(chunk, memoryview) else len(chunk)
+                if sent < size:
+                    break
+                sent -= size
+            else:
+                return              # All sent: no suspend at all
+            chunks = (memoryview(chunk).cast('B')[sent:],) + chunks[index + 1:]
+        self.writelines(chunks)
+        await self.flush()
+
+    async def close(self):
+        try:
+            await self.flush()
+        finally:
+            sched.close(self.sock)
+
+
+class IncompleteReadError(EOFError):
+    # EOF arrived before the requested data was complete
+    def __init__(self, partial, expected):
+        super().__init__('%d bytes read, %s expected' % (len(partial), expected))
+        self.partial = partial
+        self.expected = expected
+
+
+class LimitOverrunError(Exception):
+    # A line/frame grew past the reader's limit
+    def __init__(self, message, consumed):
+        super().__init__(message)
+        self.consumed = consumed
+
+
+class StreamReader:
+    # Buffered reader for a socket with the usual framing helpers. Incoming
+    # data lands in one bytearray via recv_into. Consumed bytes are skipped
+    # by moving a start offset, and the live bytes are only moved to the
+    # front (or the buffer doubled) when the free space at the end runs out.
+    # Parsing a long pipelined stream is linear, with no bytes concatenation.
+    # No single line or frame may exceed `limit` bytes.
+    def __init__(self, sock, limit=64 * 1024, read_size=16 * 1024, header='!I'):
+        self.sock = sock
+        self.limit = limit
+        self.read_size = read_size              # Free space wanted per recv
+        self._header = struct.Struct(header)    # Length prefix for read_frame
+        self._buf = bytearray(read_size)
+        self._start = 0
+        self._end = 0
+        self._eof = False
+
+    def buffered(self):
+        return self._end - self._start
+
+    def at_eof(self):
+        return self._eof and self._start == self._end
+
+    async def _fill(self):
+        buf = self._buf
+        if len(buf) - self._end < self.read_size:
+            size = self._end - self._start
+            if size + self.read_size <= len(buf) // 2:
+                buf[:size] = buf[self._start:self._end]     # Compact
+            else:
+                buf = bytearray(max(2 * len(buf), size + self.read_size))
+                buf[:size] = self._buf[self._start:self._end]
+                self._buf = buf
+            self._start = 0
+            self._end = size
+        nbytes = await sched.recv_into(self.sock, memoryview(buf)[self._end:])
+        if not nbytes:
+            self._eof = True
+        self._end += nbytes
+        return nbytes
+
+    def _take(self, nbytes):
+        start = self._start
+        data = bytes(memoryview(self._buf)[start:start + nbytes])
+        self._start = start + nbytes
+        if self._start == self._end:
+            self._start = self._end = 0
+        return data
+
+    async def read(self, n=-1):
+        # Up to n bytes (n=-1: everything until EOF); b'' at EOF
+        if n == 0:
+            return b''
+        if n < 0:
+            while not self._eof:
+                await self._fill()
+            return self._take(self.buffered())
+        if not self.buffered() and not self._eof:
+            await self._fill()
+        return self._take(min(n, self.buffered()))
+
+    async def readexactly(self, n):
+        while self.buffered() < n:
+            if self._eof:
+                raise IncompleteReadError(self._take(self.buffered()), n)
+            await self._fill()
+        return self._take(n)
+
+    async def readuntil(self, separator=b'\n'):
+        # Data up to and including separator. Each byte is scanned once:
+        # after a miss the search resumes where it left off.
+        seplen = len(separator)
+        offset = 0
+        while True:
+            pos = self._buf.find(separator, self._start + offset, self._end)
+            if pos >= 0:
+                size = pos + seplen - self._start
+                if size > self.limit:
+                    raise LimitOverrunError('Separator found beyond the limit', size)
+                return self._take(size)
+            offset = max(0, self.buffered() - seplen + 1)
+            if self.buffered() > self.limit:
+                raise LimitOverrunError('Separator not found within the limit', self.buffered())
+            if self._eof:
+                raise IncompleteReadError(self._take(self.buffered()), None)
+            await self._fill()
+
+    async def readline(self):
+        # Like readuntil(b'\n'), but returns what's left (maybe b'') at EOF
+        try:
+            return await self.readuntil(b'\n')
+        except IncompleteReadError as e:
+            return e.partial
+
+    async def read_frame(self):
+        # Length-prefixed message: header (default 4-byte big-endian length)
+        # followed by that many bytes. Returns b'' on a clean EOF.
+        size = self._header.size
+        while self.buffered() < size:
+            if self._eof:
+                if not self.buffered():
+                    return b''
+                raise IncompleteReadError(self._take(self.buffered()), size)
+            await self._fill()
+        length, = self._header.unpack_from(self._buf, self._start)
+        if length > self.limit:
+            raise LimitOverrunError('Frame of %d bytes exceeds the limit' % length, 0)
+        self._start += size
+        return await self.readexactly(length)
+
 
 # Coroutine-based tasks
 async def producer(q, count):
@@ -164,9 +1471,6 @@ async def consumer(q):
         print('Consuming', item)
     print('Consumer done')
 
-q = AsyncQueue()
-sched.new_task(producer(q, 10))
-sched.new_task(consumer(q))
 
 # Call-back based tasks
 def countdown(n):
@@ -185,29 +1489,165 @@ def countup(stop):
     _run(0)
 
 
-sched.call_soon(lambda: countdown(5))
-sched.call_soon(lambda: countup(20))
-
 from socket import *
 
 
-async def tcp_server(addr):
-    sock = socket(AF_INET, SOCK_STREAM)
-    sock.bind(addr)
-    sock.listen(1)
-    while True:
-        client, addr = await sched.accept(sock)
-        sched.new_task(echo_handler(client))
+# accept() can fail with the error of a connection that's already dead (a
+# network error, or a firewall rule for EPERM). Linux's accept(2) says to
+# treat these like EAGAIN and retry: they say nothing about the listener.
+_ACCEPT_RETRY = frozenset(getattr(errno, name) for name in (
+    'ENETDOWN', 'EPROTO', 'ENOPROTOOPT', 'EHOSTDOWN', 'ENONET', 'EHOSTUNREACH',
+    'EOPNOTSUPP', 'ENETUNREACH', 'EPERM') if hasattr(errno, name))
+
+
+class Server:
+    # Listening socket that runs `handler(client)` as a new task for every
+    # connection. The socket has a persistent read watcher; each wakeup
+    # accepts up to accept_batch pending connections without going back to
+    # the poller. With max_connections set, accepting pauses while that many
+    # handlers are running (new clients wait in the kernel's backlog) and
+    # resumes as they finish. Handlers run in the `priority` lane. With a
+    # timeout, a connection's handler is cancelled (and the socket closed)
+    # after that many seconds, so a slow client can't hold on to it forever.
+    def __init__(self, addr, handler, backlog=1024, accept_batch=64,
+                 max_connections=None, reuse_port=False, priority=PRIORITY_NORMAL,
+                 timeout=None):
+        self.addr = addr
+        self.handler = handler
+        self.priority = priority
+        self.timeout = timeout
+        self.backlog = backlog
+        self.accept_batch = accept_batch
+        self.max_connections = max_connections
+        self.reuse_port = reuse_port
+        self.sock = None
+        self.accepted = 0
+        self.rejected = 0       # Dropped on accept (out of file descriptors, ...)
+        self.active = 0         # Handlers still running
+        self.timed_out = 0      # Handlers cut off by timeout
+        self._paused = False
+        self._spare = None      # Reserve fd, given up to shed a client on EMFILE
+
+    def start(self):
+        sock = socket(AF_INET, SOCK_STREAM)
+        sock.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+        if self.reuse_port:
+            sock.setsockopt(SOL_SOCKET, SO_REUSEPORT, 1)
+        sock.bind(self.addr)
+        sock.listen(self.backlog)
+        sock.setblocking(False)
+        self.sock = sock
+        self._spare = os.open(os.devnull, os.O_RDONLY)
+        sched.add_reader(sock, self._accept_ready)
+        return self
+
+    def _accept_ready(self):
+        for _ in range(self.accept_batch):
+            try:
+                client, addr = self.sock.accept()
+            except BlockingIOError:
+                return
+            except ConnectionAbortedError:
+                continue        # Client gave up while still in the backlog
+            except OSError as e:
+                if e.errno in _ACCEPT_RETRY:
+                    self.rejected += 1
+                    continue    # That client's connection failed; not ours
+                if e.errno not in (errno.EMFILE, errno.ENFILE, errno.ENOBUFS, errno.ENOMEM):
+                    raise
+                # Still readable, so this would spin. Accept and close one
+                # client using the reserve fd instead of leaving it queued.
+                self._shed()
+                return
+            client.setblocking(False)
+            self.accepted += 1
+            self.active += 1
+            sched.new_task(self._serve(client), self.priority)
+            if self.max_connections is not None and self.active >= self.max_connections:
+                self._pause()
+                return
+
+    def _shed(self):
+        if self._spare is None:
+            return
+        os.close(self._spare)
+        self._spare = None
+        try:
+            client, _ = self.sock.accept()
+            client.close()
+            self.rejected += 1
+        except OSError:
+            pass
+        try:
+            self._spare = os.open(os.devnull, os.O_RDONLY)
+        except OSError:
+            pass            # Try again on the next shed
+
+    async def _serve(self, client):
+        try:
+            if self.timeout is None:
+                await self.handler(client)
+            else:
+                await sched.wait_for(self.handler(client), self.timeout)
+        except TimeoutError:
+            self.timed_out += 1
+            sched.close(client)
+        finally:
+            self.active -= 1
+            if self._paused and self.active < self.max_connections:
+                self._resume()
+
+    def _pause(self):
+        self._paused = True
+        sched.remove_reader(self.sock)
+
+    def _resume(self):
+        self._paused = False
+        if self.sock is not None:
+            sched.add_reader(self.sock, self._accept_ready)
+
+    def close(self):
+        # Stop accepting; running handlers carry on
+        if self.sock is not None:
+            sched.close(self.sock)
+            self.sock = None
+        if self._spare is not None:
+            os.close(self._spare)
+            self._spare = None
+
+    def stats(self):
+        return {'accepted': self.accepted, 'rejected': self.rejected,
+                'active': self.active, 'timed_out': self.timed_out,
+                'paused': self._paused}
+
+
+def tcp_server(addr, **options):
+    return Server(addr, echo_handler, **options).start()
 
 
 async def echo_handler(sock):
-    while True:
-        data = await sched.recv(sock, 10000)
-        if not data:
-            break
-        await sched.send(sock, b'Got:' + data)
-    print('Connection closed')
-    sock.close()
+    buf = ReadBuffer()          # Pooled, sized to this connection's reads
+    writer = StreamWriter(sock)
+    try:
+        while True:
+            data = await buf.recv(sched, sock)
+            if not data:
+                break
+            # Prefix and payload go out in one sendmsg(), without b'Got:' + data.
+            # Wait for it to go out: data is a view of buf, reused by the next read.
+            await writer.sendall(b'Got:', data)
+        print('Connection closed')
+    finally:
+        buf.close()             # Also when cancelled (Server timeout)
+        sched.close(sock)
+
+
+if __name__ == '__main__':
+    q = AsyncQueue()
+    sched.new_task(producer(q, 10))
+    sched.new_task(consumer(q))
+    sched.call_soon(lambda: countdown(5))
+    sched.call_soon(lambda: countup(20))
+    tcp_server(('', 3000))
+    sched.run()
 
-sched.new_task(tcp_server(('', 3000)))
-sched.run()
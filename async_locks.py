@@ -0,0 +1,191 @@
+# async_locks.py
+#
+# Synchronization primitives for Tasks on the Scheduler in async_io.py:
+# Semaphore, BoundedSemaphore, Lock, Event and Condition.
+#
+# Using an AsyncQueue as a lock means an item (and a deque slot) per
+# acquire. These keep a counter or flag instead, and a deque of the tasks
+# that are suspended on it. A wakeup is a popleft() onto the ready queue:
+# FIFO and O(1). Event.set() moves every waiter in one extend(). Waiters
+# park the same way the AsyncQueue getters do (task.waiting_on), so
+# task.cancel() and wait_for() work on them.
+#
+# Admission control, e.g. at most 64 echo handlers in the expensive part:
+#
+#   expensive = Semaphore(64)
+#
+#   async def handler(sock):
+#       ...
+#       async with expensive:
+#           await do_expensive_work(data)
+
+from collections import deque
+
+import async_io
+from async_io import CancelledError, switch
+
+
+def _park(waiters):
+    # Suspend the current task in `waiters` until something wakes it.
+    # Returns the awaitable to suspend on.
+    sched = async_io.sched
+    task = sched.current
+    waiters.append(task)
+    task.waiting_on = waiters       # (so cancel() can find it)
+    sched.current = None
+    return switch()
+
+
+def _wake(waiters):
+    task = waiters.popleft()
+    task.sched.ready.append(task)
+
+
+class Semaphore:
+    # At most `value` holders at a time; acquire() waits for a release().
+    # release() with tasks waiting doesn't put the permit back: it hands it
+    # to the oldest waiter, so a task that releases and acquires again in a
+    # loop can't take it first (FIFO, one wakeup per permit).
+    def __init__(self, value=1):
+        if value < 0:
+            raise ValueError('Semaphore initial value must be >= 0')
+        self._value = value
+        self._waiters = deque()
+        self._granted = set()       # Woken with a permit, not yet running
+
+    def locked(self):
+        return self._value == 0
+
+    async def acquire(self):
+        if self._value > 0 and not self._waiters:
+            self._value -= 1        # Uncontended: no suspend at all
+            return True
+        # Otherwise queue up behind the tasks already waiting (FIFO)
+        task = async_io.sched.current
+        try:
+            await _park(self._waiters)
+        except BaseException:
+            if task in self._granted:           # Cancelled after the handoff
+                self._granted.discard(task)
+                self.release()                  # Pass the permit on
+            raise
+        self._granted.discard(task)
+        return True
+
+    def release(self):
+        if self._waiters:
+            task = self._waiters.popleft()
+            self._granted.add(task)
+            task.sched.ready.append(task)
+        else:
+            self._value += 1
+
+    async def __aenter__(self):
+        await self.acquire()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.release()
+
+
+class BoundedSemaphore(Semaphore):
+    # A Semaphore that refuses to be released more often than acquired
+    def __init__(self, value=1):
+        Semaphore.__init__(self, value)
+        self._bound = value
+
+    def release(self):
+        if self._value >= self._bound:
+            raise ValueError('BoundedSemaphore released too many times')
+        Semaphore.release(self)
+
+
+class Lock(Semaphore):
+    def __init__(self):
+        Semaphore.__init__(self, 1)
+
+    def release(self):
+        if self._value:
+            raise RuntimeError('Lock is not acquired')
+        Semaphore.release(self)
+
+
+class Event:
+    def __init__(self):
+        self._flag = False
+        self._waiters = deque()
+
+    def is_set(self):
+        return self._flag
+
+    def set(self):
+        # Every waiter goes onto the ready queue in one pass, and each of
+        # them runs once: nothing is woken just to find it has to wait again
+        if not self._flag:
+            self._flag = True
+            if self._waiters:
+                waiters = self._waiters
+                waiters[0].sched.ready.extend(waiters)
+                waiters.clear()
+
+    def clear(self):
+        self._flag = False
+
+    async def wait(self):
+        if not self._flag:
+            await _park(self._waiters)
+        return True
+
+
+class Condition:
+    # wait() until notify(). The lock (a new Lock unless one is given) must
+    # be held around wait() and notify(), and is held again when wait() returns.
+    def __init__(self, lock=None):
+        self._lock = lock if lock is not None else Lock()
+        self.locked = self._lock.locked
+        self.acquire = self._lock.acquire
+        self.release = self._lock.release
+        self._waiters = deque()
+
+    async def __aenter__(self):
+        await self._lock.acquire()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self._lock.release()
+
+    async def wait(self):
+        if not self.locked():
+            raise RuntimeError('cannot wait on an un-acquired Condition')
+        self.release()
+        try:
+            await _park(self._waiters)
+            return True
+        finally:
+            # Take the lock back whatever happened, even if cancelled while
+            # waiting for it (the cancel is raised once we hold it)
+            cancelled = None
+            while True:
+                try:
+                    await self._lock.acquire()
+                    break
+                except CancelledError as e:
+                    cancelled = e
+            if cancelled is not None:
+                raise cancelled
+
+    async def wait_for(self, predicate):
+        result = predicate()
+        while not result:
+            await self.wait()
+            result = predicate()
+        return result
+
+    def notify(self, n=1):
+        if not self.locked():
+            raise RuntimeError('cannot notify an un-acquired Condition')
+        waiters = self._waiters
+        while waiters and n > 0:
+            _wake(waiters)
+            n -= 1
+
+    def notify_all(self):
+        self.notify(len(self._waiters))
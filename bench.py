@@ -0,0 +1,321 @@
+# bench.py
+#
+# Benchmarks every scheduler in the repo against the others:
+#
+#   callbacks   - call_soon() chains, callbacks run per second
+#   switches    - tasks doing nothing but `await switch()`, switches per second
+#   queue       - producer/consumer pairs over each file's AsyncQueue (plus
+#                 the threaded queue.Queue version from producer.py), items
+#                 moved per second
+#   timers      - 10k..1M sleepers with deadlines spread over 1ms, timers
+#                 fired per second (call_later where there is one, otherwise
+#                 tasks awaiting sched.sleep)
+#   memory      - tracemalloc bytes per newly created task
+#
+# The scheduler files are loaded with importlib (async-await_producer.py
+# isn't a valid module name) with their demos behind __name__ guards. Each
+# benchmark gives the module a fresh Scheduler as module-global `sched`,
+# which is what its queues and tasks use. A scheduler is only measured on
+# what it supports. Results go to a JSON file so runs can be compared.
+#
+#   python bench.py [--quick] [--repeat N] [--sizes 10000,100000] [--output FILE]
+
+import argparse
+import gc
+import importlib.util
+import inspect
+import json
+import os
+import platform
+import queue
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# (file, programming model) in the order the README introduces them
+VARIANTS = [
+    ('main.py', 'callbacks'),
+    ('async_producer.py', 'callbacks'),
+    ('a_pro_clean.py', 'callbacks'),
+    ('yield_it.py', 'coroutines'),
+    ('async-await_producer.py', 'coroutines'),
+    ('async_cb_coro.py', 'callbacks + tasks'),
+    ('async_io.py', 'callbacks + tasks + I/O'),
+]
+
+
+def load(filename):
+    name = filename[:-3].replace('-', '_')
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.spec_from_file_location(name, os.path.join(HERE, filename))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def fresh(mod):
+    # Schedulers that hold OS resources (async_io's poller) are shut down
+    # before being replaced
+    old = getattr(mod, 'sched', None)
+    if hasattr(old, 'shutdown'):
+        old.shutdown()
+    mod.sched = mod.Scheduler()
+    return mod.sched
+
+
+def timed(sched):
+    start = time.perf_counter()
+    sched.run()
+    return time.perf_counter() - start
+
+
+# ---- Benchmarks. Each returns a rate, or None if the scheduler can't do it.
+
+def bench_callbacks(mod, count=1000000, chains=100):
+    if not hasattr(mod.Scheduler, 'call_soon'):
+        return None
+    sched = fresh(mod)
+    per_chain = count // chains
+
+    def chain(n):
+        if n:
+            sched.call_soon(lambda: chain(n - 1))
+
+    for _ in range(chains):
+        sched.call_soon(lambda: chain(per_chain))
+    return chains * (per_chain + 1) / timed(sched)
+
+
+def bench_switches(mod, count=1000000, tasks=100):
+    if not hasattr(mod, 'switch') or not hasattr(mod.Scheduler, 'new_task'):
+        return None
+    sched = fresh(mod)
+    switch = mod.switch
+    per_task = count // tasks
+
+    async def spinner():
+        for _ in range(per_task):
+            await switch()
+
+    for _ in range(tasks):
+        sched.new_task(spinner())
+    return per_task * tasks / timed(sched)
+
+
+def bench_queue(mod, count=1000000, pairs=10):
+    if not hasattr(mod, 'AsyncQueue'):
+        return None
+    sched = fresh(mod)
+    per_pair = count // pairs
+    AsyncQueue = mod.AsyncQueue
+    if inspect.iscoroutinefunction(AsyncQueue.get):
+        async def producer(q):
+            for n in range(per_pair):
+                await q.put(n)
+            await q.put(None)
+
+        async def consumer(q):
+            while await q.get() is not None:
+                pass
+
+        for _ in range(pairs):
+            q = AsyncQueue()
+            sched.new_task(producer(q))
+            sched.new_task(consumer(q))
+    else:
+        # Callback queues: get(callback) hands over a Result
+        def producer(q):
+            def _run(n):
+                if n < per_pair:
+                    q.put(n)
+                    sched.call_soon(lambda: _run(n + 1))
+                else:
+                    q.put(None)
+            _run(0)
+
+        def consumer(q):
+            def _consume(result):
+                if result.result() is not None:
+                    sched.call_soon(lambda: q.get(_consume))
+            q.get(_consume)
+
+        for _ in range(pairs):
+            q = AsyncQueue()
+            sched.call_soon(lambda q=q: producer(q))
+            sched.call_soon(lambda q=q: consumer(q))
+    return pairs * per_pair / timed(sched)
+
+
+def bench_threads(count=1000000, pairs=10):
+    # Baseline: producer.py's threads around a queue.Queue
+    per_pair = count // pairs
+
+    def producer(q):
+        for n in range(per_pair):
+            q.put(n)
+        q.put(None)
+
+    def consumer(q):
+        while q.get() is not None:
+            pass
+
+    threads = []
+    for _ in range(pairs):
+        q = queue.Queue()
+        threads.append(threading.Thread(target=producer, args=(q,)))
+        threads.append(threading.Thread(target=consumer, args=(q,)))
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return pairs * per_pair / (time.perf_counter() - start)
+
+
+def bench_timers(mod, sleepers):
+    # Deadlines spread over 1ms, so this is mostly timer bookkeeping
+    sched = fresh(mod)
+    fired = [0]
+    if hasattr(sched, 'call_later'):
+        api = 'call_later'
+
+        def wake():
+            fired[0] += 1
+
+        start = time.perf_counter()
+        for n in range(sleepers):
+            sched.call_later((n % 1000) * 1e-6, wake)
+    else:
+        api = 'sleep'
+
+        async def sleeper(delay):
+            await sched.sleep(delay)
+            fired[0] += 1
+
+        start = time.perf_counter()
+        for n in range(sleepers):
+            sched.new_task(sleeper((n % 1000) * 1e-6))
+    sched.run()
+    elapsed = time.perf_counter() - start
+    assert fired[0] == sleepers
+    return api, sleepers / elapsed
+
+
+def bench_memory(mod, tasks=100000):
+    if not hasattr(mod.Scheduler, 'new_task'):
+        return None
+    sched = fresh(mod)
+    switch = mod.switch
+
+    async def idle():
+        await switch()
+
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    for _ in range(tasks):
+        sched.new_task(idle())
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    sched.run()         # Finish them, or they'd warn "never awaited"
+    return used / tasks
+
+
+# ---- Driver
+
+def best(func, repeat):
+    # Highest rate of `repeat` runs (None passes through)
+    results = [func() for _ in range(repeat)]
+    if results[0] is None:
+        return None
+    return max(results)
+
+
+def run_all(sizes, repeat, count):
+    results = {}
+    for filename, model in VARIANTS:
+        mod = load(filename)
+        entry = results[filename] = {'model': model}
+        entry['callbacks_per_sec'] = best(lambda: bench_callbacks(mod, count), repeat)
+        entry['switches_per_sec'] = best(lambda: bench_switches(mod, count), repeat)
+        entry['queue_items_per_sec'] = best(lambda: bench_queue(mod, count), repeat)
+        entry['timers'] = {}
+        for size in sizes:
+            api, rate = max((bench_timers(mod, size) for _ in range(repeat)),
+                            key=lambda r: r[1])
+            entry['timers'][str(size)] = {'api': api, 'per_sec': rate}
+        memory = bench_memory(mod)
+        entry['memory_per_task_bytes'] = memory if memory is None else round(memory, 1)
+        report(filename, entry)
+    results['producer.py'] = entry = {'model': 'threads'}
+    entry['queue_items_per_sec'] = best(lambda: bench_threads(count), repeat)
+    report('producer.py', entry)
+    return results
+
+
+def report(filename, entry):
+    def rate(value):
+        return '-' if value is None else '%.0f' % value
+    print('%-24s %-24s callbacks/s %10s  switches/s %10s  items/s %10s' % (
+        filename, entry['model'], rate(entry.get('callbacks_per_sec')),
+        rate(entry.get('switches_per_sec')), rate(entry.get('queue_items_per_sec'))))
+    timers = entry.get('timers', {})
+    if timers:
+        print('%49s timers/s %s' % ('', '  '.join(
+            '%s: %s (%s)' % (size, rate(t['per_sec']), t['api']) for size, t in timers.items())))
+    if entry.get('memory_per_task_bytes') is not None:
+        print('%49s memory/task %.0f bytes' % ('', entry['memory_per_task_bytes']))
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=HERE,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the schedulers in this repo')
+    parser.add_argument('--sizes', default='10000,100000,1000000',
+                        help='comma separated sleeper counts for the timer benchmark')
+    parser.add_argument('--count', type=int, default=1000000,
+                        help='callbacks/switches/items per benchmark run')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per benchmark (best is kept)')
+    parser.add_argument('--quick', action='store_true',
+                        help='--count 100000 --sizes 10000,100000 --repeat 1')
+    parser.add_argument('--output', default='bench_results.json', help="JSON results file ('-' for stdout)")
+    args = parser.parse_args()
+    if args.quick:
+        args.count, args.sizes, args.repeat = 100000, '10000,100000', 1
+    sizes = [int(size) for size in args.sizes.split(',')]
+
+    results = {
+        'meta': {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'revision': git_revision(),
+            'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'platform': platform.platform(),
+            'count': args.count,
+            'repeat': args.repeat,
+        },
+        'results': run_all(sizes, args.repeat, args.count),
+    }
+    if args.output == '-':
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print('Results written to', args.output)
+
+
+if __name__ == '__main__':
+    main()
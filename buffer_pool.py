@@ -0,0 +1,96 @@
+# buffer_pool.py
+#
+# Reusable receive buffers for Scheduler.recv_into() in async_io.py.
+#
+# sock.recv(10000) hands back a brand new bytes object on every read. With
+# recv_into() the kernel writes into a buffer we already own, and the data
+# is looked at through a memoryview (no copy). Buffers come out of a pool
+# in power-of-two size classes and go back to it when a connection is done.
+# Each connection's buffer size follows its traffic: reads that fill the
+# buffer double it, and a run of reads that use less than a quarter of it
+# halves it.
+
+
+class BufferPool:
+    def __init__(self, min_size=1024, max_size=256 * 1024, max_free=64):
+        self.min_size = min_size
+        self.max_size = max_size
+        self.max_free = max_free     # Free buffers kept per size class
+        self._free = {}              # size class -> [bytearray, ...]
+        self.allocated = 0
+        self.reused = 0
+
+    def size_class(self, size):
+        if size <= self.min_size:
+            return self.min_size
+        return min(1 << (size - 1).bit_length(), self.max_size)
+
+    def acquire(self, size):
+        size = self.size_class(size)
+        free = self._free.get(size)
+        if free:
+            self.reused += 1
+            return free.pop()
+        self.allocated += 1
+        return bytearray(size)
+
+    def release(self, buf):
+        size = len(buf)
+        if size != self.size_class(size):
+            return                   # Not one of ours
+        free = self._free.setdefault(size, [])
+        if len(free) < self.max_free:
+            free.append(buf)
+
+    def stats(self):
+        return {'allocated': self.allocated, 'reused': self.reused,
+                'free': {size: len(free) for size, free in self._free.items() if free}}
+
+
+default_pool = BufferPool()
+
+
+class ReadBuffer:
+    # One connection's receive buffer, sized by what its reads look like
+    SHRINK_AFTER = 2                 # Consecutive small reads before shrinking
+
+    def __init__(self, pool=None, initial=4096):
+        self.pool = pool if pool is not None else default_pool
+        self.size = self.pool.size_class(initial)
+        self._small_reads = 0
+        self._buf = None
+        self._view = None
+
+    def _ensure(self):
+        if self._buf is None or len(self._buf) != self.size:
+            if self._buf is not None:
+                self.pool.release(self._buf)
+            self._buf = self.pool.acquire(self.size)
+            self._view = memoryview(self._buf)
+
+    def record(self, nbytes):
+        # Adapt the next read's size to this one
+        if nbytes >= self.size:
+            self.size = self.pool.size_class(self.size * 2)
+            self._small_reads = 0
+        elif nbytes < self.size // 4 and self.size > self.pool.min_size:
+            self._small_reads += 1
+            if self._small_reads >= self.SHRINK_AFTER:
+                self.size = self.pool.size_class(self.size // 2)
+                self._small_reads = 0
+        else:
+            self._small_reads = 0
+
+    async def recv(self, sched, sock):
+        # Returns a memoryview of the bytes just read. It is only valid until
+        # the next recv() or close() -- copy it (bytes(data)) to keep it.
+        self._ensure()
+        nbytes = await sched.recv_into(sock, self._view)
+        self.record(nbytes)
+        return self._view[:nbytes]
+
+    def close(self):
+        if self._buf is not None:
+            self._view.release()
+            self.pool.release(self._buf)
+            self._buf = self._view = None
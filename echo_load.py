@@ -0,0 +1,358 @@
+# echo_load.py
+#
+# Load generator for the echo server in async_io.py (Server/echo_handler),
+# running on the same Scheduler. It opens N connections to the server and
+# sends newline-terminated requests. However the server's reads split or
+# merge them, every request gets exactly one b'\n' back, so a reply is one
+# readline().
+#
+#   closed loop (default): each connection sends a request, waits for the
+#       reply and immediately sends the next one.
+#   open loop (--rate R): R requests/second in total, spread evenly over
+#       the connections, sent on schedule whether or not replies are back.
+#       Latency counts from when a request was *due*, so a stalled server
+#       shows up in the numbers instead of just slowing the senders down.
+#
+# Latency goes into an HDR-style log-linear histogram (microseconds,
+# under 1% error), reported as p50/p99/p999 and a percentile distribution.
+#
+#   python echo_load.py [-c 1000] [-d 10] [--rate 50000] [--spawn 1]
+#
+# --spawn N starts the server too: tcp_server() for N=1, sharded_server.py
+# with N workers otherwise.
+
+import argparse
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import time
+from collections import deque
+from socket import *
+
+import async_io
+from async_io import StreamReader, StreamWriter
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+PORTS_PER_SOURCE_IP = 25000     # Stay inside the ephemeral port range
+
+
+class LatencyHistogram:
+    # Values are integer microseconds. Below 2**bits every value has its own
+    # bucket; above that each power of two is split into 2**(bits-1) linear
+    # sub-buckets. Memory stays small and every value is reported within
+    # 1 part in 2**(bits-1) of what was recorded.
+    def __init__(self, bits=8):
+        self.bits = bits
+        self.half = 1 << (bits - 1)
+        self.counts = {}            # bucket index -> count
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = 0
+
+    def _index(self, value):
+        shift = value.bit_length() - self.bits
+        if shift <= 0:
+            return value
+        return shift * self.half + (value >> shift)
+
+    def _highest(self, index):
+        # Largest value that falls into bucket `index`
+        if index < 2 * self.half:
+            return index
+        shift = index // self.half - 1
+        return ((index - shift * self.half + 1) << shift) - 1
+
+    def record(self, seconds):
+        value = int(seconds * 1e6)
+        if value < 0:
+            value = 0
+        index = self._index(value)
+        self.counts[index] = self.counts.get(index, 0) + 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        for index, n in other.counts.items():
+            self.counts[index] = self.counts.get(index, 0) + n
+        self.count += other.count
+        self.total += other.total
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+        self.max = max(self.max, other.max)
+
+    def percentile(self, pct):
+        # Microseconds at or below which pct percent of the values fall
+        if not self.count:
+            return 0
+        rank = max(1, self.count * pct / 100.0)
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= rank:
+                return min(self._highest(index), self.max)
+        return self.max
+
+    def distribution(self, ticks_per_half=5):
+        # (percentile, value, count so far) rows the way HdrHistogram prints
+        # them: 5 steps from 0 to 50%, 5 more to 75%, to 87.5%, ...
+        rows = []
+        if not self.count:
+            return rows
+        level = 0
+        while True:
+            low = 100.0 - 100.0 / 2 ** level
+            step = 100.0 / 2 ** (level + 1) / ticks_per_half
+            for tick in range(ticks_per_half):
+                pct = low + tick * step
+                rows.append((pct, self.percentile(pct), int(round(self.count * pct / 100.0))))
+            level += 1
+            if 2 ** level > self.count:
+                break
+        rows.append((100.0, self.max, self.count))
+        return rows
+
+    def snapshot(self):
+        ms = 1e-3
+        return {
+            'count': self.count,
+            'min_ms': (self.min or 0) * ms,
+            'mean_ms': self.total / self.count * ms if self.count else 0.0,
+            'p50_ms': self.percentile(50) * ms,
+            'p90_ms': self.percentile(90) * ms,
+            'p99_ms': self.percentile(99) * ms,
+            'p999_ms': self.percentile(99.9) * ms,
+            'p9999_ms': self.percentile(99.99) * ms,
+            'max_ms': self.max * ms,
+        }
+
+
+class LoadGenerator:
+    def __init__(self, addr, connections=100, duration=10.0, rate=None, size=64,
+                 warmup=1.0, source_ips=1, connect_concurrency=256):
+        self.addr = addr
+        self.connections = connections
+        self.duration = duration
+        self.rate = rate                    # None: closed loop
+        self.payload = b'x' * (max(size, 1) - 1) + b'\n'
+        self.warmup = warmup
+        self.source_ips = source_ips
+        self.connect_concurrency = connect_concurrency
+        self.histogram = LatencyHistogram()
+        self.socks = []
+        self.requests = 0                   # Replies inside the measured window
+        self.connect_errors = 0
+        self.errors = 0                     # Connections lost during the run
+        self._connectors = 0
+        self.measure_from = self.stop_at = None
+
+    # ---- Connection ramp: a few connector tasks share one iterator of indexes
+    def start(self):
+        indexes = iter(range(self.connections))
+        self._connectors = min(self.connect_concurrency, self.connections)
+        for _ in range(self._connectors):
+            async_io.sched.new_task(self._connector(indexes))
+
+    async def _connector(self, indexes):
+        sched = async_io.sched
+        for index in indexes:
+            sock = socket(AF_INET, SOCK_STREAM)
+            try:
+                if self.source_ips > 1:
+                    # Each loopback address has its own ephemeral ports
+                    sock.bind(('127.0.0.%d' % (1 + index % self.source_ips), 0))
+                await sched.connect(sock, self.addr)
+                sock.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+            except OSError:
+                self.connect_errors += 1
+                sock.close()
+                continue
+            self.socks.append(sock)
+        self._connectors -= 1
+        if not self._connectors:
+            self._run()
+
+    def _run(self):
+        # Everyone is connected: start the clock and the load
+        now = time.monotonic()
+        self.measure_from = now + self.warmup
+        self.stop_at = self.measure_from + self.duration
+        load = self.open_loop if self.rate else self.closed_loop
+        for sock in self.socks:
+            async_io.sched.new_task(load(sock))
+
+    def _record(self, due, done):
+        if due >= self.measure_from:
+            self.histogram.record(done - due)
+            self.requests += 1
+
+    # ---- Load
+    async def closed_loop(self, sock):
+        clock = time.monotonic
+        reader = StreamReader(sock)
+        writer = StreamWriter(sock)
+        payload = self.payload
+        try:
+            while True:
+                sent = clock()
+                if sent >= self.stop_at:
+                    break
+                writer.write(payload)
+                if not await reader.readline():
+                    raise ConnectionResetError('server closed the connection')
+                self._record(sent, clock())
+        except OSError:
+            self.errors += 1
+        finally:
+            async_io.sched.close(sock)
+
+    async def open_loop(self, sock):
+        # Sending runs as a call_later() chain so it never waits on replies;
+        # this task only reads them.
+        sched = async_io.sched
+        clock = time.monotonic
+        reader = StreamReader(sock)
+        writer = StreamWriter(sock)
+        payload = self.payload
+        stop_at = self.stop_at
+        interval = len(self.socks) / self.rate
+        due = deque()                       # When each unanswered request was due
+        next_due = [clock() + random.random() * interval]
+
+        def send():
+            now = clock()
+            try:
+                # Behind schedule: send everything that's overdue right away
+                while next_due[0] <= now and next_due[0] < stop_at:
+                    due.append(next_due[0])
+                    writer.write(payload)
+                    next_due[0] += interval
+            except OSError:
+                return
+            if next_due[0] < stop_at:
+                sched.call_later(next_due[0] - now, send)
+
+        send()
+        try:
+            while due or next_due[0] < stop_at:
+                if not await reader.readline():
+                    raise ConnectionResetError('server closed the connection')
+                self._record(due.popleft(), clock())
+        except OSError:
+            self.errors += 1
+            next_due[0] = stop_at           # Stop the sender too
+        finally:
+            sched.close(sock)
+
+    # ---- Results
+    def results(self):
+        return {
+            'mode': 'open' if self.rate else 'closed',
+            'connections': len(self.socks),
+            'connect_errors': self.connect_errors,
+            'errors': self.errors,
+            'duration': self.duration,
+            'rate': self.rate,
+            'size': len(self.payload),
+            'requests': self.requests,
+            'throughput': self.requests / self.duration,
+            'latency': self.histogram.snapshot(),
+        }
+
+    def report(self, out=sys.stdout):
+        r = self.results()
+        print('%s loop, %d connections (%d failed to connect, %d lost), %d byte requests'
+              % (r['mode'], r['connections'], r['connect_errors'], r['errors'], r['size']), file=out)
+        if self.rate:
+            print('Target rate %.0f req/s' % self.rate, file=out)
+        print('%d requests in %.1fs: %.0f req/s' % (r['requests'], r['duration'], r['throughput']),
+              file=out)
+        lat = r['latency']
+        print('Latency ms: min %.3f  p50 %.3f  p99 %.3f  p999 %.3f  max %.3f'
+              % (lat['min_ms'], lat['p50_ms'], lat['p99_ms'], lat['p999_ms'], lat['max_ms']), file=out)
+        print('\n%12s %14s %12s %16s' % ('Value(ms)', 'Percentile', 'TotalCount', '1/(1-Percentile)'),
+              file=out)
+        for pct, value, count in self.histogram.distribution():
+            inverse = '%16.2f' % (1 / (1 - pct / 100.0)) if pct < 100.0 else '%16s' % 'inf'
+            print('%12.3f %14.6f %12d %s' % (value / 1000.0, pct / 100.0, count, inverse), file=out)
+
+
+def raise_nofile(wanted):
+    # Every connection is a file descriptor (two, if the server is local)
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    target = wanted if hard == resource.RLIM_INFINITY else min(wanted, hard)
+    if soft < target:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (target, hard))
+        soft = target
+    if soft < wanted:
+        print('Warning: RLIMIT_NOFILE is %d, fewer than the %d needed' % (soft, wanted),
+              file=sys.stderr)
+
+
+def spawn_server(host, port, workers):
+    if workers > 1:
+        args = [sys.executable, 'sharded_server.py', str(port), str(workers)]
+    else:
+        args = [sys.executable, '-c', 'import async_io; async_io.tcp_server((%r, %d)); '
+                'async_io.sched.run()' % (host, port)]
+    server = subprocess.Popen(args, cwd=HERE, stdout=subprocess.DEVNULL)
+    deadline = time.monotonic() + 5.0
+    while True:                         # Wait for it to listen
+        try:
+            create_connection((host, port), timeout=1.0).close()
+            return server
+        except OSError:
+            if time.monotonic() > deadline or server.poll() is not None:
+                server.kill()
+                raise RuntimeError('server did not start')
+            time.sleep(0.05)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load generator for the async_io echo server')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=3000)
+    parser.add_argument('-c', '--connections', type=int, default=100)
+    parser.add_argument('-d', '--duration', type=float, default=10.0, help='seconds measured')
+    parser.add_argument('-w', '--warmup', type=float, default=1.0, help='seconds before measuring')
+    parser.add_argument('-r', '--rate', type=float, help='open loop: total requests/second')
+    parser.add_argument('-s', '--size', type=int, default=64, help='request size in bytes')
+    parser.add_argument('--source-ips', type=int,
+                        help='loopback source addresses to spread connections over '
+                             '(default: one per %d connections)' % PORTS_PER_SOURCE_IP)
+    parser.add_argument('--spawn', type=int, metavar='WORKERS',
+                        help='start the echo server with this many worker processes')
+    parser.add_argument('--json', metavar='FILE', help='also write the results as JSON')
+    args = parser.parse_args()
+
+    source_ips = args.source_ips
+    if source_ips is None:
+        source_ips = 1
+        if args.host.startswith('127.'):
+            source_ips = -(-args.connections // PORTS_PER_SOURCE_IP)
+    raise_nofile(2 * args.connections + 256)
+    server = spawn_server(args.host, args.port, args.spawn) if args.spawn else None
+    try:
+        gen = LoadGenerator((args.host, args.port), args.connections, args.duration, args.rate,
+                            args.size, args.warmup, source_ips)
+        gen.start()
+        async_io.sched.run()
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+    gen.report()
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(gen.results(), f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,206 @@
+# loop_metrics.py
+#
+# Opt-in instrumentation for the Scheduler in async_io.py.
+#
+#   metrics = sched.enable_metrics(slow_callback=0.05)
+#   ...
+#   print(metrics.snapshot())
+#
+# While metrics are off, Scheduler.run only pays for one attribute check
+# per loop iteration. While they're on, every tick records how many
+# callbacks ran, how deep the ready queue and timer structures were, how
+# long the loop was blocked in the poller versus running callbacks, and how
+# late each timer fired. Callbacks (including Task steps) that run longer
+# than `slow_callback` seconds are logged as warnings.
+
+import logging
+import time
+
+log = logging.getLogger('async_io')
+
+
+class LagHistogram:
+    # Power-of-two buckets in microseconds: bucket k counts values below
+    # 2**k us (bucket 0 is "under 1us", the last one catches everything).
+    BUCKETS = 32
+
+    def __init__(self):
+        self.counts = [0] * self.BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        if seconds < 0:
+            seconds = 0.0
+        usec = int(seconds * 1e6)
+        bucket = min(usec.bit_length(), self.BUCKETS - 1)
+        self.counts[bucket] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, pct):
+        # Upper bound (seconds) of the bucket holding the pct-th value
+        if not self.count:
+            return 0.0
+        rank = self.count * pct / 100.0
+        seen = 0
+        for bucket, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank:
+                return min((1 << bucket) / 1e6, self.max)
+        return self.max
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else 0.0,
+            'p50': self.percentile(50),
+            'p99': self.percentile(99),
+            'max': self.max,
+            # {"<N us": count} for the non-empty buckets
+            'buckets': {'<%dus' % (1 << bucket): n for bucket, n in enumerate(self.counts) if n},
+        }
+
+
+def describe(func):
+    # Readable name for something sitting in the ready queue
+    coro = getattr(func, 'coro', None)
+    if coro is not None:
+        return 'Task(%s)' % getattr(coro, '__qualname__', coro)
+    inner = getattr(func, 'func', None)         # TimerHandle
+    if inner is not None:
+        return describe(inner)
+    return getattr(func, '__qualname__', repr(func))
+
+
+class LoopMetrics:
+    def __init__(self, slow_callback=0.1):
+        self.slow_callback = slow_callback    # seconds; None disables warnings
+        self._reporter = None
+        self.reset()
+
+    def reset(self):
+        self.started = time.perf_counter()
+        self.ticks = 0
+        self._tick_count = 0
+        self.callbacks = 0
+        self.last_tick_callbacks = 0
+        self.max_tick_callbacks = 0
+        self.ready_depth = 0
+        self.max_ready_depth = 0
+        self.heap_size = 0
+        self.wheel_size = 0
+        self.poll_time = 0.0          # Blocked in the poller (select/epoll)
+        self.run_time = 0.0           # Running callbacks
+        self.slow_callbacks = 0
+        self.slowest = 0.0
+        self.slowest_name = None
+        self.lag = LagHistogram()
+        self.lanes = []               # Per priority lane, once lanes are in use
+
+    # ---- Called by Scheduler.run
+    def tick_started(self, sched):
+        self.ticks += 1
+        self._tick_count = 0
+        depth = len(sched.ready)
+        self.ready_depth = depth
+        if depth > self.max_ready_depth:
+            self.max_ready_depth = depth
+        self.heap_size = len(sched.sleeping.heap)
+        self.wheel_size = len(sched.sleeping.wheel)
+
+    def timers_fired(self, now, handles):
+        for handle in handles:
+            self.lag.add(now - handle.deadline)
+
+    def lanes_started(self, depths):
+        # Queue depth of every priority lane at the start of a tick
+        while len(self.lanes) < len(depths):
+            self.lanes.append({'depth': 0, 'max_depth': 0, 'callbacks': 0})
+        for lane, depth in zip(self.lanes, depths):
+            lane['depth'] = depth
+            if depth > lane['max_depth']:
+                lane['max_depth'] = depth
+
+    def run_ready(self, ready, count, lane=None):
+        # Same as the plain drain of `count` callbacks in Scheduler.run, but
+        # timed. With lanes in use this runs once per lane per round.
+        clock = time.perf_counter
+        threshold = self.slow_callback
+        popleft = ready.popleft
+        tick_start = clock()
+        for _ in range(count):
+            func = popleft()
+            start = clock()
+            func()
+            elapsed = clock() - start
+            if threshold is not None and elapsed > threshold:
+                self.slow(func, elapsed)
+        self.ran(count, clock() - tick_start, lane)
+
+    def ran(self, count, elapsed, lane=None):
+        # Account for `count` callbacks that took `elapsed` seconds in all.
+        # (tracing.Tracer runs the callbacks itself while tracing, and
+        # reports them here.)
+        self.run_time += elapsed
+        self.callbacks += count
+        if lane is not None:
+            self.lanes[lane]['callbacks'] += count
+            count += self._tick_count       # Earlier lanes in this tick
+        self._tick_count = count
+        self.last_tick_callbacks = count
+        if count > self.max_tick_callbacks:
+            self.max_tick_callbacks = count
+
+    def slow(self, func, elapsed):
+        name = describe(func)
+        self.slow_callbacks += 1
+        if elapsed > self.slowest:
+            self.slowest = elapsed
+            self.slowest_name = name
+        log.warning('Slow callback %s took %.3f seconds', name, elapsed)
+
+    # ---- Reading the numbers
+    def snapshot(self):
+        wall = time.perf_counter() - self.started
+        return {
+            'uptime': wall,
+            'ticks': self.ticks,
+            'callbacks': self.callbacks,
+            'callbacks_per_tick': self.callbacks / self.ticks if self.ticks else 0.0,
+            'last_tick_callbacks': self.last_tick_callbacks,
+            'max_tick_callbacks': self.max_tick_callbacks,
+            'ready_depth': self.ready_depth,
+            'max_ready_depth': self.max_ready_depth,
+            'sleeping_heap': self.heap_size,
+            'sleeping_wheel': self.wheel_size,
+            'poll_time': self.poll_time,
+            'run_time': self.run_time,
+            'poll_fraction': self.poll_time / wall if wall else 0.0,
+            'run_fraction': self.run_time / wall if wall else 0.0,
+            'slow_callbacks': self.slow_callbacks,
+            'slowest_callback': self.slowest_name,
+            'slowest_time': self.slowest,
+            'loop_lag': self.lag.snapshot(),
+            # Indexed by priority (PRIORITY_HIGH = 0 ...)
+            'lanes': [dict(lane) for lane in self.lanes],
+        }
+
+    def start_reporter(self, sched, interval=10.0, report=print, reset=False):
+        # Call report(snapshot) every `interval` seconds. The reporter's timer
+        # keeps Scheduler.run() alive, so stop_reporter() when done.
+        def _report():
+            report(self.snapshot())
+            if reset:
+                self.reset()
+            self._reporter = sched.call_later(interval, _report, coarse=True)
+        self.stop_reporter()
+        self._reporter = sched.call_later(interval, _report, coarse=True)
+
+    def stop_reporter(self):
+        if self._reporter is not None:
+            self._reporter.cancel()
+            self._reporter = None
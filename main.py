@@ -67,17 +67,23 @@ class Scheduler:
         # self.sleeping.sort()   # Sort by closest deadline
 
     def run(self):
+        # One tick at a time: timers that are due join the ready queue, then
+        # only the callbacks ready at that point run. Ones they add wait for
+        # the next tick, so a callback that keeps rescheduling itself can't
+        # hold back the timers.
         while self.ready or self.sleeping:
             if not self.ready:
                 # Find the nearest deadline
                 # Use of heapq is more efficient and includes the sorting bit
-                deadline, _, func = heapq.heappop(self.sleeping)
                 # deadline, func = self.sleeping.pop(0)
-                delta = deadline - time.time()
+                delta = self.sleeping[0][0] - time.time()
                 if delta > 0:
                     time.sleep(delta)
+            now = time.time()
+            while self.sleeping and self.sleeping[0][0] <= now:
+                deadline, _, func = heapq.heappop(self.sleeping)
                 self.ready.append(func)
-            while self.ready:
+            for _ in range(len(self.ready)):
                 func = self.ready.popleft()
                 func()
 
@@ -107,6 +113,7 @@ def countup(stop, x=0):  # make x a default arg because it's carrying internal s
     _run(0)
 
 
-sched.call_soon(lambda: countdown(5))
-sched.call_soon(lambda: countup(20))  # arg of 5 to 20 since up is running much faster than down
-sched.run()
+if __name__ == '__main__':
+    sched.call_soon(lambda: countdown(5))
+    sched.call_soon(lambda: countup(20))  # arg of 5 to 20 since up is running much faster than down
+    sched.run()
@@ -0,0 +1,205 @@
+# pollers.py
+#
+# I/O readiness backends for the Scheduler in async_io.py.
+#
+# select() is handed every waiting file descriptor on every call, so its cost
+# grows with the number of connections and it can't go past FD_SETSIZE (1024).
+# A poller keeps the interest set inside the kernel instead: a descriptor is
+# registered once and only *changes* to its interest cost a system call.
+# poll() then only reports the descriptors that are actually ready.
+
+import select
+import selectors
+import time
+from collections import deque
+
+EVENT_READ = selectors.EVENT_READ      # 1
+EVENT_WRITE = selectors.EVENT_WRITE    # 2
+
+
+class EpollPoller:
+    # Linux epoll(7). Registrations live in the kernel until modified/removed.
+    def __init__(self):
+        self._epoll = select.epoll()
+        self._max_events = 1024
+
+    def fileno(self):
+        return self._epoll.fileno()
+
+    def _mask(self, events, edge):
+        mask = select.EPOLLET if edge else 0
+        if events & EVENT_READ:
+            mask |= select.EPOLLIN
+        if events & EVENT_WRITE:
+            mask |= select.EPOLLOUT
+        return mask
+
+    def register(self, fd, events, edge=False):
+        self._epoll.register(fd, self._mask(events, edge))
+
+    def modify(self, fd, events, edge=False):
+        self._epoll.modify(fd, self._mask(events, edge))
+
+    def unregister(self, fd):
+        self._epoll.unregister(fd)
+
+    def poll(self, timeout=None):
+        if timeout is None:
+            timeout = -1                 # Wait forever
+        ready = []
+        for fd, mask in self._epoll.poll(timeout, self._max_events):
+            events = 0
+            # Errors and hang-ups wake both sides so the waiter sees the failure
+            if mask & (select.EPOLLIN | select.EPOLLERR | select.EPOLLHUP):
+                events |= EVENT_READ
+            if mask & (select.EPOLLOUT | select.EPOLLERR | select.EPOLLHUP):
+                events |= EVENT_WRITE
+            ready.append((fd, events))
+        return ready
+
+    def close(self):
+        self._epoll.close()
+
+
+class SelectorPoller:
+    # Portable fallback on top of the selectors module (kqueue, devpoll,
+    # poll or select -- whatever the platform does best).
+    def __init__(self, selector=None):
+        self._selector = selector if selector is not None else selectors.DefaultSelector()
+
+    def fileno(self):
+        return self._selector.fileno() if hasattr(self._selector, 'fileno') else -1
+
+    # Edge-triggered interest isn't portable: `edge` is accepted and ignored
+    def register(self, fd, events, edge=False):
+        self._selector.register(fd, events)
+
+    def modify(self, fd, events, edge=False):
+        self._selector.modify(fd, events)
+
+    def unregister(self, fd):
+        self._selector.unregister(fd)
+
+    def poll(self, timeout=None):
+        if not self._selector.get_map():
+            # Some backends (select on Windows) refuse an empty interest set
+            if timeout is None:
+                raise RuntimeError('poll() with nothing registered would block forever')
+            if timeout > 0:
+                time.sleep(timeout)
+            return []
+        return [(key.fd, events) for key, events in self._selector.select(timeout)]
+
+    def close(self):
+        self._selector.close()
+
+
+class RecordingPoller:
+    # Wraps another poller and keeps what every poll() reported, as
+    # (seconds since start, [(registration, events), ...]) -- the run's I/O
+    # schedule, for ReplayPoller. An fd is logged as the number of its
+    # registration (0 for the first register() call, 1 for the next...)
+    # rather than the fd itself, which another process may number
+    # differently. Pass the Scheduler's clock when it isn't monotonic.
+    #
+    # Only what goes through poll() is logged, so a Scheduler given this
+    # poller (or a ReplayPoller) sets io_budget = 0: recv/send/accept always
+    # wait for readiness instead of trying the socket first. With the fast
+    # path, a recv() whose data is already there never shows up in the log,
+    # and the replay would run it at a different point.
+    io_fast_path = False
+
+    def __init__(self, poller=None, clock=time.monotonic):
+        self.poller = poller if poller is not None else default_poller()
+        self.clock = clock
+        self.start = clock()
+        self.log = []
+        self._registrations = {}     # fd -> registration number
+        self._count = 0
+
+    def fileno(self):
+        return self.poller.fileno()
+
+    def register(self, fd, events, edge=False):
+        self.poller.register(fd, events, edge)
+        self._registrations[fd] = self._count
+        self._count += 1
+
+    def modify(self, fd, events, edge=False):
+        self.poller.modify(fd, events, edge)
+
+    def unregister(self, fd):
+        self.poller.unregister(fd)
+        del self._registrations[fd]
+
+    def poll(self, timeout=None):
+        ready = self.poller.poll(timeout)
+        if ready:
+            self.log.append((self.clock() - self.start,
+                             [(self._registrations[fd], events) for fd, events in ready]))
+        return ready
+
+    def close(self):
+        self.poller.close()
+
+
+class ReplayPoller:
+    # Plays back a RecordingPoller log instead of asking the kernel: each
+    # poll() returns the next recorded batch of ready fds. With a
+    # VirtualClock (timers.py) the clock is moved to when the batch
+    # happened, so wakeups, timers and timeouts interleave exactly as they
+    # did in the recorded run. Only readiness is replayed -- the socket calls
+    # made after a wakeup still go to the (test's own) sockets, which have
+    # to be registered in the same order as in the recorded run.
+    io_fast_path = False        # (see RecordingPoller)
+
+    def __init__(self, log, clock=None):
+        self.log = deque(log)
+        self.clock = clock
+        # With a VirtualClock, poll() moves the clock itself: the Scheduler
+        # hands it the full timeout instead of jumping past recorded I/O
+        self.advances_clock = hasattr(clock, 'advance_to')
+        self.start = clock() if clock is not None else 0.0
+        self._fds = {}               # registration number -> fd
+        self._count = 0
+
+    def fileno(self):
+        return -1
+
+    def register(self, fd, events, edge=False):
+        self._fds[self._count] = fd
+        self._count += 1
+
+    def modify(self, fd, events, edge=False):
+        pass
+
+    def unregister(self, fd):
+        pass
+
+    def poll(self, timeout=None):
+        advance_to = getattr(self.clock, 'advance_to', None)
+        if not self.log:
+            if timeout is None:
+                raise RuntimeError('replay log exhausted with nothing else to wait for')
+            if advance_to is not None:
+                advance_to(self.clock() + timeout)
+            return []
+        at, ready = self.log[0]
+        if advance_to is not None:
+            at += self.start
+            if timeout is not None and at > self.clock() + timeout:
+                advance_to(self.clock() + timeout)   # A timer comes first
+                return []
+            advance_to(at)
+        self.log.popleft()
+        return [(self._fds[registration], events) for registration, events in ready]
+
+    def close(self):
+        self.log.clear()
+
+
+def default_poller():
+    # Best available backend for this platform
+    if hasattr(select, 'epoll'):
+        return EpollPoller()
+    return SelectorPoller()
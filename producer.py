@@ -25,7 +25,8 @@ def consumer(q):
     print('Consumer done')
 
 
-q = queue.Queue()    # Thread safe queue
-threading.Thread(target=producer, args=(q, 10)).start()
-threading.Thread(target=consumer, args=(q,)).start()
+if __name__ == '__main__':
+    q = queue.Queue()    # Thread safe queue
+    threading.Thread(target=producer, args=(q, 10)).start()
+    threading.Thread(target=consumer, args=(q,)).start()
 
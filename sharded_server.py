@@ -0,0 +1,172 @@
+# sharded_server.py
+#
+# The echo server from async_io.py on every core.
+#
+# One Scheduler is one thread, and the GIL keeps it on one core. Here a
+# supervisor process forks N workers. Each worker has its own Scheduler and
+# its own listening socket bound to the same port with SO_REUSEPORT, so the
+# kernel spreads new connections across the workers. Every worker reports
+# its connection counts to the supervisor over a socketpair. When a worker
+# dies, its end of the socketpair hits EOF and the supervisor starts a
+# replacement, after a delay that doubles each time the worker in that slot
+# dies soon after starting. A slot whose worker keeps dying at startup (the
+# port is taken, say) is given up instead of being restarted forever.
+#
+#   python sharded_server.py [port] [workers]
+
+import os
+import sys
+import time
+import traceback
+from socket import *
+
+import async_io
+from async_io import Server, echo_handler
+
+REPORT_INTERVAL = 1.0     # Seconds between worker -> supervisor reports
+RESTART_DELAY = 0.1       # First restart delay; doubles per crash in a row
+MAX_RESTART_DELAY = 10.0
+STABLE_TIME = 10.0        # A worker that ran this long wasn't a crash loop
+MAX_CRASHES = 5           # Crashes in a row before a slot is given up
+
+
+# ---- Worker process
+
+def worker_server(addr, max_connections=None):
+    # Every worker binds the same port; the kernel balances between them
+    return Server(addr, echo_handler, max_connections=max_connections,
+                  reuse_port=True).start()
+
+
+async def worker_reporter(report, server):
+    sched = async_io.sched
+    while True:
+        await sched.send(report, b'%d %d\n' % (server.accepted, server.active))
+        await sched.sleep(REPORT_INTERVAL)
+
+
+def worker_main(addr, report, max_connections=None):
+    # fork() copied the supervisor's Scheduler, including its epoll fd (and
+    # an epoll set is shared between processes). Start from a fresh one.
+    # Task and echo_handler look up async_io.sched when they run. The old
+    # one is kept referenced so its unstarted tasks aren't reported as
+    # "never awaited" while being garbage collected.
+    inherited = async_io.sched
+    inherited.shutdown()
+    sched = async_io.sched = async_io.Scheduler()
+    server = worker_server(addr, max_connections)
+    sched.new_task(worker_reporter(report, server))
+    sched.run()
+    return inherited
+
+
+# ---- Supervisor process
+
+class Supervisor:
+    def __init__(self, addr, workers=None, max_connections=None):
+        self.addr = addr
+        self.workers = workers or os.cpu_count() or 1
+        self.max_connections = max_connections   # Per worker
+        self.pids = {}          # index -> pid of the worker in that slot
+        self.socks = {}         # index -> supervisor end of its socketpair
+        self.stats = {}         # index -> (accepted, active) last reported
+        self.started = {}       # index -> time.monotonic() its worker started
+        self.crashes = {}       # index -> quick deaths in a row
+        self.given_up = set()   # Slots that crashed MAX_CRASHES times in a row
+        self.restarts = 0
+
+    def spawn(self, index):
+        parent_end, child_end = socketpair()
+        pid = os.fork()
+        if pid == 0:
+            # Worker. Never return into the supervisor's code. Drop the
+            # supervisor's sockets, or a dead worker's socketpair would
+            # stay open (and registered) in every later worker.
+            parent_end.close()
+            for sock in self.socks.values():
+                sock.close()
+            status = 0
+            try:
+                worker_main(self.addr, child_end, self.max_connections)
+            except KeyboardInterrupt:
+                pass
+            except BaseException:
+                traceback.print_exc()
+                status = 1
+            os._exit(status)
+        child_end.close()
+        self.pids[index] = pid
+        self.socks[index] = parent_end
+        self.stats[index] = (0, 0)
+        self.started[index] = time.monotonic()
+        async_io.sched.new_task(self.watch(index, pid, parent_end))
+
+    async def watch(self, index, pid, sock):
+        # Collect reports until the worker goes away, then replace it
+        sched = async_io.sched
+        pending = b''
+        while True:
+            data = await sched.recv(sock, 4096)
+            if not data:
+                break
+            pending += data
+            lines = pending.split(b'\n')
+            pending = lines.pop()
+            if lines:
+                accepted, active = lines[-1].split()
+                self.stats[index] = (int(accepted), int(active))
+        sched.close(sock)
+        _, status = os.waitpid(pid, 0)
+        del self.pids[index], self.socks[index], self.stats[index]
+        code = os.waitstatus_to_exitcode(status)
+        how = 'was killed by signal %d' % -code if code < 0 else 'exited with status %d' % code
+        ran = time.monotonic() - self.started[index]
+        if ran >= STABLE_TIME:
+            self.crashes[index] = 0
+        crashes = self.crashes[index] = self.crashes.get(index, 0) + 1
+        if crashes >= MAX_CRASHES:
+            print('Worker %d (pid %d) %s after %.1fs, %d quick exits in a row: giving up on it'
+                  % (index, pid, how, ran, crashes))
+            self.given_up.add(index)
+            return
+        delay = min(RESTART_DELAY * 2 ** (crashes - 1), MAX_RESTART_DELAY)
+        print('Worker %d (pid %d) %s after %.1fs, restarting in %.1fs' % (index, pid, how, ran, delay))
+        await sched.sleep(delay)
+        self.restarts += 1
+        self.spawn(index)
+
+    def totals(self):
+        accepted = sum(a for a, _ in self.stats.values())
+        active = sum(b for _, b in self.stats.values())
+        return {'workers': len(self.pids), 'accepted': accepted, 'active': active,
+                'restarts': self.restarts, 'given_up': sorted(self.given_up),
+                'per_worker': {self.pids[i]: self.stats[i] for i in self.pids}}
+
+    async def report(self, interval):
+        while len(self.given_up) < self.workers:
+            await async_io.sched.sleep(interval)
+            print(self.totals())
+
+    def run(self, report_interval=5.0):
+        for index in range(self.workers):
+            self.spawn(index)
+        if report_interval:
+            async_io.sched.new_task(self.report(report_interval))
+        try:
+            async_io.sched.run()
+        finally:
+            for pid in self.pids.values():
+                try:
+                    os.kill(pid, 15)    # SIGTERM
+                    os.waitpid(pid, 0)
+                except OSError:
+                    pass
+
+
+if __name__ == '__main__':
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 3000
+    workers = int(sys.argv[2]) if len(sys.argv) > 2 else None
+    try:
+        Supervisor(('', port), workers).run()
+    except KeyboardInterrupt:
+        pass
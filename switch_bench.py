@@ -0,0 +1,69 @@
+# switch_bench.py
+#
+# Microbenchmark for the task switch path in async_io.py: how many times
+# per second the Scheduler can suspend a Task and resume it again.
+#
+#   yield      - tasks that do nothing but `await switch()` in a loop
+#   ping-pong  - two tasks bouncing one item over a pair of AsyncQueues
+#                (every hand-off is a suspend in get() + a wakeup in put())
+#
+#   python switch_bench.py [switches] [repeat]
+
+import sys
+import time
+
+import async_io
+from async_io import AsyncQueue, Scheduler, switch
+
+
+def bench_yield(switches, tasks=100):
+    sched = async_io.sched = Scheduler()
+    per_task = switches // tasks
+
+    async def spinner():
+        for _ in range(per_task):
+            await switch()
+
+    for _ in range(tasks):
+        sched.new_task(spinner())
+    start = time.perf_counter()
+    sched.run()
+    elapsed = time.perf_counter() - start
+    sched.shutdown()
+    return per_task * tasks / elapsed
+
+
+def bench_ping_pong(switches):
+    sched = async_io.sched = Scheduler()
+    rounds = switches // 2
+    ping = AsyncQueue()
+    pong = AsyncQueue()
+
+    async def server():
+        for _ in range(rounds):
+            await pong.put(await ping.get())
+
+    async def client():
+        for n in range(rounds):
+            await ping.put(n)
+            await pong.get()
+
+    sched.new_task(server())
+    sched.new_task(client())
+    start = time.perf_counter()
+    sched.run()
+    elapsed = time.perf_counter() - start
+    sched.shutdown()
+    return rounds * 2 / elapsed
+
+
+def main(switches=1000000, repeat=3):
+    for name, bench in (('yield', bench_yield), ('ping-pong', bench_ping_pong)):
+        best = max(bench(switches) for _ in range(repeat))
+        print('%-10s %12.0f switches/s' % (name, best))
+
+
+if __name__ == '__main__':
+    switches = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    main(switches, repeat)
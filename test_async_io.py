@@ -0,0 +1,567 @@
+# test_async_io.py
+#
+# Regression tests for Task/Future wakeups and cancellation in async_io.py.
+#
+#   python -m unittest test_async_io
+
+import errno
+import gc
+import os
+import socket
+import struct
+import time
+import unittest
+
+import async_io
+from async_io import (AsyncQueue, CancelledError, IncompleteReadError, LimitOverrunError,
+                      Scheduler, Server, StreamReader, StreamWriter)
+from timers import VirtualClock
+
+
+class FutureTest(unittest.TestCase):
+    def setUp(self):
+        self.sched = async_io.sched = Scheduler()
+
+    def test_cancel_after_wakeup_resumes_once(self):
+        # set_result() has already queued the waiter when cancel() arrives:
+        # it must get the CancelledError once, not be queued a second time
+        sched = self.sched
+        fut = sched.create_future()
+        steps = []
+
+        async def waiter():
+            try:
+                await fut
+            except CancelledError:
+                steps.append('cancelled')
+            await sched.sleep(0.05)
+            steps.append('slept')
+            return 'done'
+
+        task = sched.new_task(waiter())
+
+        def finish():
+            fut.set_result(1)
+            task.cancel()
+
+        sched.call_soon(finish)
+        sched.run()
+        self.assertEqual(steps, ['cancelled', 'slept'])
+        self.assertEqual(task.result(), 'done')
+
+    def test_wait_for_timeouts_go_on_the_timing_wheel(self):
+        sched = self.sched
+        fut = sched.create_future()
+        seen = []
+
+        async def main():
+            try:
+                await sched.wait_for(fut, 0.02)
+            except TimeoutError:
+                seen.append('timeout')
+
+        sched.new_task(main())
+        sched.call_soon(lambda: seen.append((len(sched.sleeping.wheel), len(sched.sleeping.heap))))
+        sched.run()
+        self.assertEqual(seen, [(1, 0), 'timeout'])
+
+    def test_add_done_callback_after_removing_the_last_one(self):
+        sched = self.sched
+        calls = []
+
+        def unwanted(f):
+            calls.append('unwanted')
+
+        pending = sched.create_future()
+        pending.add_done_callback(unwanted)
+        pending.remove_done_callback(unwanted)
+        pending.set_result(1)
+        sched.run()
+        pending.add_done_callback(lambda f: calls.append(('pending', f.result())))
+
+        # Removed again after the future finished, with _run_callbacks queued
+        finished = sched.create_future()
+        finished.add_done_callback(unwanted)
+        finished.set_result(2)
+        finished.remove_done_callback(unwanted)
+        finished.add_done_callback(lambda f: calls.append(('finished', f.result())))
+        sched.run()
+        self.assertEqual(calls, [('pending', 1), ('finished', 2)])
+
+
+class QueueTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = VirtualClock()
+        self.sched = async_io.sched = Scheduler(clock=self.clock)
+
+    def test_get_many_times_out_when_its_item_is_taken(self):
+        # The put wakes the get_many() task and the timeout fires before it
+        # runs, but another getter takes the item in between: get_many()
+        # still has to return [] at its deadline, not wait for the next put
+        sched, clock = self.sched, self.clock
+        q = AsyncQueue()
+        got = []
+
+        async def batch_getter():
+            got.append((await q.get_many(10, timeout=0.05), clock()))
+
+        async def putter(delay, item):
+            await sched.sleep(delay)
+            await q.put(item)
+
+        async def taker():
+            await sched.sleep(0.05)
+            got.append((await q.get(), clock()))
+
+        sched.new_task(batch_getter())
+        sched.new_task(putter(0.05, 'x'))
+        sched.new_task(taker())
+        sched.new_task(putter(100, 'y'))
+        sched.run()
+        self.assertEqual(got[:2], [('x', 0.05), ([], 0.05)])
+
+    def test_cancelled_batch_waiters_pass_their_wakeup_on(self):
+        # Cancelled right after a put_many()/get_many() picked them to run:
+        # the next waiter gets the item (or the free slot) instead
+        sched = self.sched
+        got = []
+
+        async def batch_getter(q, name):
+            got.append((name, await q.get_many(10)))
+
+        async def batch_putter(q, items, name):
+            await q.put_many(items)
+            got.append(name)
+
+        q = AsyncQueue()
+        first = sched.new_task(batch_getter(q, 'first'))
+        sched.new_task(batch_getter(q, 'second'))
+        full = AsyncQueue(maxsize=1)
+        full.items.append('old')
+        stuck = sched.new_task(batch_putter(full, ['a'], 'stuck'))
+        sched.new_task(batch_putter(full, ['b'], 'next'))
+
+        async def main():
+            await sched.sleep(0.01)
+            await q.put_many(['x'])
+            first.cancel()
+            self.assertEqual(await full.get_many(1), ['old'])
+            stuck.cancel()
+
+        sched.new_task(main())
+        sched.run()
+        self.assertEqual(got, [('second', ['x']), 'next'])
+        self.assertTrue(first.cancelled() and stuck.cancelled())
+        self.assertEqual((list(q.items), list(q.waiting)), ([], []))
+        self.assertEqual((list(full.items), list(full.putting)), (['b'], []))
+
+
+class GatherTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = VirtualClock()
+        self.sched = async_io.sched = Scheduler(clock=self.clock)
+        self.running = 0
+        self.most_running = 0
+        self.started = []
+
+    async def job(self, name, delay, fail=False):
+        self.started.append(name)
+        self.running += 1
+        self.most_running = max(self.most_running, self.running)
+        try:
+            await self.sched.sleep(delay)
+        finally:
+            self.running -= 1
+        if fail:
+            raise KeyError(name)
+        return name
+
+    def run_main(self, main):
+        task = self.sched.new_task(main())
+        self.sched.run()
+        return task.result()
+
+    def test_gather_keeps_argument_order_within_the_limit(self):
+        sched = self.sched
+
+        async def main():
+            return await sched.gather(*[self.job(n, 5 - n) for n in range(5)], limit=2)
+
+        self.assertEqual(self.run_main(main), [0, 1, 2, 3, 4])
+        self.assertEqual(self.most_running, 2)
+        self.assertEqual(self.started, [0, 1, 2, 3, 4])
+
+    def test_gather_first_error_cancels_the_rest(self):
+        sched = self.sched
+        jobs = [self.job('slow', 10), self.job('bad', 1, fail=True), self.job('late', 1)]
+
+        async def main():
+            try:
+                await sched.gather(*jobs, limit=2)
+            except KeyError as e:
+                return e.args[0], self.clock()
+
+        self.assertEqual(self.run_main(main), ('bad', 1.0))
+        self.assertEqual(self.started, ['slow', 'bad'])    # 'late' never started
+        self.assertEqual(self.running, 0)                   # 'slow' was cancelled
+
+    def test_gather_return_exceptions(self):
+        sched = self.sched
+
+        async def main():
+            return await sched.gather(self.job('a', 2), self.job('b', 1, fail=True),
+                                      return_exceptions=True)
+
+        result = self.run_main(main)
+        self.assertEqual(result[0], 'a')
+        self.assertIsInstance(result[1], KeyError)
+
+    def test_as_completed_in_finishing_order(self):
+        sched = self.sched
+
+        async def main():
+            order = []
+            async for task in sched.as_completed([self.job(n, 4 - n) for n in range(4)], limit=3):
+                order.append((task.result(), self.clock()))
+            return order
+
+        # 3 starts when 2 finishes, and is done at the same time as 1
+        self.assertEqual(self.run_main(main), [(2, 2.0), (1, 3.0), (3, 3.0), (0, 4.0)])
+        self.assertEqual(self.most_running, 3)
+
+    def test_leaving_as_completed_early_cancels_the_rest(self):
+        sched = self.sched
+
+        async def main():
+            async for task in sched.as_completed([self.job(n, n + 1) for n in range(5)], limit=3):
+                break
+            return task.result()
+
+        self.assertEqual(self.run_main(main), 0)
+        self.assertEqual(self.started, [0, 1, 2, 3])     # 3 took 0's slot; 4 never ran
+        self.assertEqual(self.running, 0)
+        self.assertEqual(self.clock(), 1.0)
+
+    def test_limit_below_one_is_an_error(self):
+        sched = self.sched
+
+        async def main():
+            errors = []
+            for limit in (0, -1):
+                try:
+                    await sched.gather(self.job('a', 1), limit=limit)
+                except ValueError:
+                    errors.append('gather')
+                try:
+                    async for task in sched.as_completed([self.job('b', 1)], limit=limit):
+                        pass
+                except ValueError:
+                    errors.append('as_completed')
+            return errors
+
+        self.assertEqual(self.run_main(main), ['gather', 'as_completed'] * 2)
+        self.assertEqual(self.started, [])
+
+
+class ExecutorTest(unittest.TestCase):
+    def setUp(self):
+        self.sched = async_io.sched = Scheduler()
+        self.addCleanup(self.sched.shutdown)
+
+    def check_timeout(self, offload, call_time):
+        # wait_for() gives up on a blocking call at its timeout, not when
+        # the call finally returns; the late result is dropped
+        sched = self.sched
+        seen = []
+
+        async def main():
+            start = time.monotonic()
+            try:
+                await sched.wait_for(offload(time.sleep, call_time), 0.05)
+            except TimeoutError:
+                seen.append(time.monotonic() - start)
+            await sched.sleep(call_time)        # The result comes in meanwhile
+            seen.append('after')
+
+        sched.new_task(main())
+        sched.run()
+        self.assertEqual(len(seen), 2)
+        self.assertLess(seen[0], call_time / 2)
+        self.assertEqual(seen[1], 'after')
+        self.assertEqual(sched._executor_pending, 0)
+
+    def test_wait_for_times_out_run_in_executor(self):
+        self.check_timeout(self.sched.run_in_executor, 0.5)
+
+    def test_wait_for_times_out_run_in_process(self):
+        self.check_timeout(self.sched.run_in_process, 0.5)
+
+
+class StreamWriterTest(unittest.TestCase):
+    def setUp(self):
+        self.sched = async_io.sched = Scheduler()
+        self.a, self.b = socket.socketpair()
+        self.addCleanup(self.a.close)
+        self.addCleanup(self.b.close)
+
+    def test_sendall_with_nothing_queued_doesnt_suspend(self):
+        sched = self.sched
+        writer = StreamWriter(self.a)
+        steps = []
+
+        async def main():
+            sched.call_soon(lambda: steps.append('next tick'))
+            await writer.sendall(b'Got:', memoryview(b'hello'))
+            steps.append('sent')
+
+        sched.new_task(main())
+        sched.run()
+        self.assertEqual(steps, ['sent', 'next tick'])
+        self.assertEqual(self.b.recv(100), b'Got:hello')
+
+    def test_sendall_finishes_a_short_write(self):
+        sched = self.sched
+        writer = StreamWriter(self.a)
+        self.a.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+        header, payload = b'H' * 10, bytes(range(256)) * 4096
+        received = bytearray()
+
+        async def send():
+            await writer.sendall(header, payload)
+            self.assertEqual(writer.buffered(), 0)
+            self.a.shutdown(socket.SHUT_WR)
+
+        async def receive():
+            while True:
+                data = await sched.recv(self.b, 65536)
+                if not data:
+                    break
+                received.extend(data)
+
+        sched.new_task(send())
+        sched.new_task(receive())
+        sched.run()
+        self.assertEqual(bytes(received), header + payload)
+
+
+class StreamReaderTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = VirtualClock()
+        self.sched = async_io.sched = Scheduler(clock=self.clock)
+        self.a, self.b = socket.socketpair()
+        self.addCleanup(self.a.close)
+        self.addCleanup(self.b.close)
+
+    def feed(self, *chunks, eof=True):
+        # Send the chunks 1ms apart (so each one is a separate read), then
+        # close the write side
+        async def writer():
+            for chunk in chunks:
+                await self.sched.sleep(0.001)
+                self.b.sendall(chunk)
+            if eof:
+                self.b.shutdown(socket.SHUT_WR)
+        self.sched.new_task(writer())
+
+    def run_reader(self, read, **options):
+        reader = StreamReader(self.a, **options)
+        task = self.sched.new_task(read(reader))
+        self.sched.run()
+        return task.result(), reader
+
+    def test_readuntil_resumes_across_reads(self):
+        self.feed(b'GET / HT', b'TP/1.1\r', b'\nHost: x\r\n\r\nbody')
+
+        async def read(reader):
+            return [await reader.readuntil(b'\r\n'), await reader.readuntil(b'\r\n'),
+                    await reader.readuntil(b'\r\n'), await reader.read()]
+
+        lines, _ = self.run_reader(read)
+        self.assertEqual(lines, [b'GET / HTTP/1.1\r\n', b'Host: x\r\n', b'\r\n', b'body'])
+
+    def test_readuntil_limit(self):
+        self.feed(b'short\n', b'x' * 40, b'\n')
+
+        async def read(reader):
+            first = await reader.readline()
+            try:
+                await reader.readuntil(b'\n')
+            except LimitOverrunError as e:
+                return first, e.consumed
+
+        (first, consumed), _ = self.run_reader(read, limit=16, read_size=8)
+        self.assertEqual(first, b'short\n')
+        self.assertGreater(consumed, 16)
+
+    def test_separator_just_past_the_limit(self):
+        self.feed(b'x' * 16 + b'\n')
+
+        async def read(reader):
+            try:
+                await reader.readuntil(b'\n')
+            except LimitOverrunError as e:
+                return e.consumed
+
+        self.assertEqual(self.run_reader(read, limit=16)[0], 17)
+
+    def test_read_frame(self):
+        frame = lambda data: struct.pack('!I', len(data)) + data
+        self.feed(frame(b'one') + frame(b'')[:2], frame(b'')[2:] + frame(b'three')[:5],
+                  frame(b'three')[5:])
+
+        async def read(reader):
+            return [await reader.read_frame() for _ in range(4)]
+
+        frames, _ = self.run_reader(read)
+        self.assertEqual(frames, [b'one', b'', b'three', b''])     # Then a clean EOF
+
+    def test_truncated_frame(self):
+        self.feed(struct.pack('!I', 100) + b'partial')
+
+        async def read(reader):
+            try:
+                await reader.read_frame()
+            except IncompleteReadError as e:
+                return e.partial, e.expected
+
+        self.assertEqual(self.run_reader(read)[0], (b'partial', 100))
+
+    def test_frame_over_the_limit(self):
+        self.feed(struct.pack('!I', 1000))
+
+        async def read(reader):
+            try:
+                await reader.read_frame()
+            except LimitOverrunError:
+                return 'limit'
+
+        self.assertEqual(self.run_reader(read, limit=999)[0], 'limit')
+
+    def test_incomplete_reads_at_eof(self):
+        self.feed(b'abc')
+
+        async def read(reader):
+            try:
+                await reader.readexactly(5)
+            except IncompleteReadError as e:
+                partial = e.partial
+            return partial, await reader.read(10), reader.at_eof()
+
+        self.assertEqual(self.run_reader(read)[0], (b'abc', b'', True))
+
+    def test_read_zero_doesnt_wait(self):
+        self.feed(b'later', eof=False)
+
+        async def read(reader):
+            return await reader.read(0), self.clock()
+
+        self.assertEqual(self.run_reader(read)[0], (b'', 0.0))
+
+    def test_buffer_compacts_and_grows(self):
+        # Many short lines through a small buffer: the space they used is
+        # reclaimed (no growth). One long line: the buffer grows to hold it.
+        lines = [b'%04d\n' % n for n in range(200)]
+        self.feed(*[b''.join(lines[n:n + 7]) for n in range(0, 200, 7)], b'y' * 100 + b'\n')
+
+        async def read(reader):
+            got = [await reader.readline() for _ in range(200)]
+            sizes = [len(reader._buf)]
+            got.append(await reader.readline())
+            sizes.append(len(reader._buf))
+            return got, sizes
+
+        (got, sizes), _ = self.run_reader(read, read_size=32)
+        self.assertEqual(got, lines + [b'y' * 100 + b'\n'])
+        self.assertEqual(sizes[0], 64)
+        self.assertGreaterEqual(sizes[1], 101)
+
+
+class ServerTest(unittest.TestCase):
+    def setUp(self):
+        self.sched = async_io.sched = Scheduler()
+
+    def test_accept_skips_a_failed_connection(self):
+        sched = self.sched
+        served = []
+
+        async def handler(client):
+            served.append(client.recv(10))
+            sched.close(client)
+
+        server = Server(('127.0.0.1', 0), handler).start()
+        listener = server.sock
+        errors = [errno.EPROTO, errno.ENETUNREACH]
+
+        class FlakyListener:
+            # accept() reports two dead connections before the real one
+            def accept(self):
+                if errors:
+                    code = errors.pop(0)
+                    raise OSError(code, os.strerror(code))
+                return listener.accept()
+
+        client = socket.create_connection(listener.getsockname())
+        self.addCleanup(client.close)
+        client.send(b'hi')
+        server.sock = FlakyListener()
+        time.sleep(0.05)                # Let the connection reach the backlog
+        server._accept_ready()
+        server.sock = listener
+        server.close()
+        sched.run()
+        self.assertEqual((server.rejected, server.accepted), (2, 1))
+        self.assertEqual(served, [b'hi'])
+
+
+class CloseTest(unittest.TestCase):
+    def setUp(self):
+        self.sched = async_io.sched = Scheduler()
+
+    def test_close_wakes_tasks_waiting_on_the_socket(self):
+        sched = self.sched
+        a, b = socket.socketpair()
+        self.addCleanup(b.close)
+
+        async def reader():
+            await sched.recv(a, 100)
+
+        async def closer():
+            await sched.sleep(0.01)
+            sched.close(a)
+
+        task = sched.new_task(reader())
+        sched.new_task(closer())
+        sched.run()
+        self.assertTrue(task.done())
+        self.assertIsInstance(task.exception(), OSError)
+        self.assertEqual(task.exception().errno, errno.EBADF)
+        self.assertEqual(sched._io_waiting, 0)
+
+
+class ShutdownTest(unittest.TestCase):
+    def setUp(self):
+        saved = async_io.sched      # Stays open: not part of the count
+        self.addCleanup(setattr, async_io, 'sched', saved)
+
+    def open_fds(self):
+        gc.collect()
+        return len(os.listdir('/proc/self/fd'))
+
+    @unittest.skipUnless(os.path.isdir('/proc/self/fd'), 'needs /proc/self/fd')
+    def test_throwaway_schedulers_leave_no_fds(self):
+        before = self.open_fds()
+        for _ in range(50):
+            sched = async_io.sched = Scheduler()
+
+            async def blocking_call():
+                return await sched.run_in_executor(sum, [1, 2])
+
+            task = sched.new_task(blocking_call())
+            sched.run()
+            self.assertEqual(task.result(), 3)
+            sched.shutdown()
+        self.assertEqual(self.open_fds(), before)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+# test_async_locks.py
+#
+# Tests for the Semaphore/Lock handoff in async_locks.py.
+#
+#   python -m unittest test_async_locks
+
+import unittest
+
+import async_io
+from async_io import Scheduler, switch
+from async_locks import BoundedSemaphore, Lock, Semaphore
+
+
+class SemaphoreTest(unittest.TestCase):
+    def setUp(self):
+        self.sched = async_io.sched = Scheduler()
+
+    def test_release_hands_the_permit_to_the_oldest_waiter(self):
+        # A holder that releases and re-acquires in a loop must not get in
+        # front of a task that was already waiting
+        sched = self.sched
+        lock = Lock()
+        order = []
+
+        async def main():
+            await lock.acquire()
+            sched.new_task(other())
+            await switch()              # other() is now waiting
+            for n in range(3):
+                lock.release()
+                await lock.acquire()
+                order.append('main%d' % n)
+            lock.release()
+
+        async def other():
+            await lock.acquire()
+            order.append('B')
+            lock.release()
+
+        sched.new_task(main())
+        sched.run()
+        self.assertEqual(order, ['B', 'main0', 'main1', 'main2'])
+        self.assertFalse(lock.locked())
+
+    def test_cancelled_waiter_passes_a_handed_permit_on(self):
+        sched = self.sched
+        sem = Semaphore(0)
+        got = []
+
+        async def waiter(name):
+            await sem.acquire()
+            got.append(name)
+
+        first = sched.new_task(waiter('first'))
+        sched.new_task(waiter('second'))
+
+        def release_then_cancel():
+            sem.release()           # Handed to 'first'...
+            first.cancel()          # ...which is cancelled before it runs
+
+        sched.call_soon(release_then_cancel)
+        sched.run()
+        self.assertTrue(first.cancelled())
+        self.assertEqual(got, ['second'])
+        self.assertEqual(sem._value, 0)
+        self.assertEqual(sem._granted, set())
+
+    def test_bounded_semaphore_counts_handed_permits(self):
+        sched = self.sched
+        sem = BoundedSemaphore(1)
+
+        async def holder():
+            async with sem:
+                await sched.sleep(0.01)
+
+        for _ in range(3):
+            sched.new_task(holder())
+        sched.run()
+        self.assertEqual(sem._value, 1)
+        self.assertRaises(ValueError, sem.release)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,219 @@
+# test_timers.py
+#
+# Tests for timers.py: TimerHandle cancellation, the lazy-deletion heap and
+# the hierarchical timing wheel, driven by a VirtualClock.
+#
+#   python -m unittest test_timers
+
+import random
+import unittest
+from collections import deque
+
+from timers import TimerHandle, TimerQueue, TimingWheel, VirtualClock
+
+RESOLUTION = 0.01
+
+
+class TimerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = VirtualClock(1000.0)
+        self.timers = TimerQueue(self.clock, RESOLUTION)
+        self.fired = []         # (name, clock when it ran)
+
+    def add(self, delay, name, coarse=False):
+        return self.timers.call_at(self.clock() + delay,
+                                   lambda: self.fired.append((name, self.clock())), coarse)
+
+    def run_timers(self):
+        # What Scheduler.run does with a virtual clock: jump to the next
+        # deadline, expire, run what came due
+        ready = deque()
+        while self.timers:
+            self.clock.advance_to(self.timers.next_deadline())
+            self.timers.expire(self.clock(), ready)
+            while ready:
+                ready.popleft()()
+
+
+class HeapTest(TimerTestCase):
+    def test_fires_in_deadline_then_insertion_order(self):
+        self.add(0.3, 'c')
+        self.add(0.1, 'a1')
+        self.add(0.1, 'a2')
+        self.add(0.2, 'b')
+        self.run_timers()
+        self.assertEqual([name for name, _ in self.fired], ['a1', 'a2', 'b', 'c'])
+        for name, at in self.fired:
+            self.assertAlmostEqual(at, 1000.0 + {'a1': 0.1, 'a2': 0.1, 'b': 0.2, 'c': 0.3}[name])
+
+    def test_cancel(self):
+        keep = self.add(0.1, 'keep')
+        drop = self.add(0.1, 'drop')
+        self.assertEqual(len(self.timers), 2)
+        drop.cancel()
+        drop.cancel()                   # Twice is harmless
+        self.assertTrue(drop.cancelled())
+        self.assertFalse(drop.pending())
+        self.assertEqual(len(self.timers), 1)
+        self.run_timers()
+        self.assertEqual([name for name, _ in self.fired], ['keep'])
+        self.assertFalse(keep.pending())
+        self.assertFalse(keep.cancelled())
+
+    def test_cancel_after_expiry_before_running(self):
+        handle = self.add(0.1, 'late cancel')
+        ready = deque()
+        self.clock.advance(0.1)
+        self.timers.expire(self.clock(), ready)
+        self.assertEqual(list(ready), [handle])
+        handle.cancel()
+        ready.popleft()()
+        self.assertEqual(self.fired, [])
+
+    def test_compaction(self):
+        handles = [self.add(1 + n * 0.001, n) for n in range(200)]
+        for handle in handles[:150]:
+            handle.cancel()
+        # More than half cancelled: the heap was rebuilt without them
+        self.assertLess(len(self.timers.heap), 200)
+        self.assertLessEqual(self.timers._heap_cancelled * 2, len(self.timers.heap))
+        self.assertEqual(len(self.timers), 50)
+        self.run_timers()
+        self.assertEqual([name for name, _ in self.fired], list(range(150, 200)))
+        self.assertEqual(self.timers.heap, [])
+        self.assertEqual(self.timers._heap_cancelled, 0)
+
+    def test_few_cancellations_are_left_in_place(self):
+        handles = [self.add(1 + n * 0.001, n) for n in range(200)]
+        for handle in handles[:10]:
+            handle.cancel()
+        self.assertEqual(len(self.timers.heap), 200)
+        self.assertEqual(len(self.timers), 190)
+
+
+class WheelTest(TimerTestCase):
+    def test_cancel(self):
+        keep = self.add(0.5, 'keep', coarse=True)
+        drop = self.add(0.5, 'drop', coarse=True)
+        drop.cancel()
+        self.assertEqual(len(self.timers.wheel), 1)
+        self.assertEqual(len(self.timers), 1)
+        self.run_timers()
+        self.assertEqual([name for name, _ in self.fired], ['keep'])
+        self.assertFalse(keep.pending())
+
+    def test_cancel_in_an_outer_level(self):
+        far = self.add(3600, 'far', coarse=True)
+        self.assertGreater(far._level, 0)
+        far.cancel()
+        self.assertEqual(len(self.timers.wheel), 0)
+        self.assertEqual(self.timers.wheel._counts, [0, 0, 0, 0])
+        self.assertIsNone(self.timers.next_deadline())
+
+    def test_cascades_across_every_level(self):
+        wheel = self.timers.wheel
+        spans = [span * RESOLUTION for span in wheel._spans]
+        # One timer per level (just past the level below), plus one beyond
+        # the whole wheel that has to be parked and re-inserted
+        delays = [0.05, spans[0] + 0.37, spans[1] + 1.23, spans[2] + 17.1, spans[3] * 1.5]
+        handles = [self.add(delay, delay, coarse=True) for delay in delays]
+        self.assertEqual([h._level for h in handles], [0, 1, 2, 3, 3])
+        self.run_timers()
+        self.assertEqual([name for name, _ in self.fired], delays)
+        for (delay, at), handle in zip(self.fired, handles):
+            self.assertGreaterEqual(at, handle.deadline - 1e-9)
+            self.assertLessEqual(at, handle.deadline + RESOLUTION + 1e-9)
+        self.assertEqual(wheel._counts, [0, 0, 0, 0])
+
+    def test_outer_level_timer_due_before_the_next_level0_slot(self):
+        # 2.60 is past level 0's first turn, so it waits in level 1 until
+        # tick 256. At 2.50 a timer for 3.50 lands in level 0: the wheel has
+        # to wake up for the cascade at 2.56, not at 3.50.
+        self.clock = VirtualClock(0.0)
+        self.timers = TimerQueue(self.clock, RESOLUTION)
+        early = self.add(2.60, 'early', coarse=True)
+        self.assertEqual(early._level, 1)
+        self.clock.advance_to(2.50)
+        self.timers.expire(self.clock(), deque())
+        self.add(1.0, 'late', coarse=True)
+        self.assertAlmostEqual(self.timers.next_deadline(), 2.56)
+        self.run_timers()
+        self.assertEqual([name for name, _ in self.fired], ['early', 'late'])
+        self.assertAlmostEqual(self.fired[0][1], 2.60)
+        self.assertAlmostEqual(self.fired[1][1], 3.50)
+
+    def test_overdue_timer_fires_on_the_next_tick(self):
+        handle = self.add(-5, 'overdue', coarse=True)
+        self.run_timers()
+        self.assertEqual(len(self.fired), 1)
+        self.assertLessEqual(self.fired[0][1], 1000.0 + RESOLUTION + 1e-9)
+        self.assertFalse(handle.pending())
+
+
+class NeverEarlyTest(TimerTestCase):
+    # Precise timers fire exactly at their deadline; coarse ones never
+    # before it and at most one wheel tick after it -- with random deadlines
+    # from 1ms to hours away, random cancellations and timers added while
+    # others are firing.
+    def test_random_timers(self):
+        rng = random.Random(1234)
+        deadlines = {}
+        cancelled = set()
+        handles = []
+
+        def add_random(name):
+            delay = rng.choice([rng.uniform(0.001, 2), rng.uniform(2, 700),
+                                rng.uniform(700, 12000), rng.uniform(12000, 40000)])
+            coarse = rng.random() < 0.7
+            handle = self.add(delay, name, coarse)
+            deadlines[name] = (handle.deadline, coarse)
+            handles.append((name, handle))
+
+        for n in range(3000):
+            add_random(n)
+        for name, handle in rng.sample(handles, 1000):
+            handle.cancel()
+            cancelled.add(name)
+
+        # Some timers schedule another one when they fire
+        for name, handle in handles[:200]:
+            if name not in cancelled:
+                func = handle.func
+                handle.func = lambda func=func, name=name: (func(), add_random(('child', name)))
+
+        self.run_timers()
+        fired = {name for name, _ in self.fired}
+        self.assertEqual(fired & cancelled, set())
+        self.assertEqual(fired | cancelled, set(deadlines))
+        for name, at in self.fired:
+            deadline, coarse = deadlines[name]
+            self.assertGreaterEqual(at, deadline - 1e-6, name)
+            if coarse:
+                self.assertLessEqual(at, deadline + RESOLUTION + 1e-6, name)
+            else:
+                self.assertAlmostEqual(at, deadline, delta=1e-6)
+
+    def test_wheel_alone_with_irregular_clock_steps(self):
+        # Advancing by arbitrary steps (not to next_deadline()): a timer
+        # fires at the first advance() at or past its deadline, never before
+        rng = random.Random(99)
+        wheel = TimingWheel(RESOLUTION, 0.0)
+        handles = []
+        for n in range(2000):
+            handle = TimerHandle(rng.uniform(0, 400), n, None, None)
+            wheel.add(handle, 0.0)
+            handles.append(handle)
+        now = 0.0
+        seen = 0
+        while len(wheel):
+            step = rng.choice([0.003, 0.04, 1.7, 9.0])
+            for handle in wheel.advance(now + step):
+                self.assertLessEqual(handle.deadline, now + step + 1e-6)       # Not early
+                self.assertGreater(handle.deadline, now - RESOLUTION - 1e-6)   # Not missed
+                seen += 1
+            now += step
+        self.assertEqual(seen, len(handles))
+
+
+if __name__ == '__main__':
+    unittest.main()
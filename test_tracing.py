@@ -0,0 +1,83 @@
+# test_tracing.py
+#
+# Tests for tracing.Tracer: per-task accounting, for tasks started before
+# and after Tracer.start(), and its bounded task table.
+#
+#   python -m unittest test_tracing
+
+import unittest
+
+import async_io
+from async_io import Scheduler
+from tracing import Tracer
+
+
+class TracerTest(unittest.TestCase):
+    def setUp(self):
+        self.sched = async_io.sched = Scheduler()
+
+    def test_tasks_running_before_start_are_traced(self):
+        sched = self.sched
+
+        async def handler():
+            for _ in range(5):
+                await sched.sleep(0.001)
+
+        async def newcomer():
+            await sched.sleep(0.001)
+
+        sched.new_task(handler())
+        tracer = Tracer(sched)
+        sched.call_soon(tracer.start)       # Once handler() is already waiting
+        sched.call_later(0.0005, lambda: sched.new_task(newcomer()))
+        sched.run()
+        tracer.stop()
+        stats = {s['name'].rsplit('.', 1)[-1]: s for s in tracer.top()}
+        self.assertEqual(set(stats), {'handler', 'newcomer'})
+        self.assertEqual(stats['handler']['resumes'], 5)     # Every step after start()
+        self.assertTrue(stats['handler']['done'])
+        self.assertTrue(stats['handler']['site'].startswith('test_tracing.py:'))
+        self.assertEqual(stats['newcomer']['resumes'], 2)
+        self.assertEqual(tracer._live, {})
+        steps = [event for event in tracer.events if event[0] > 0]
+        self.assertEqual(len(steps), 7)
+
+    def test_finished_tasks_are_pruned_beyond_max_tasks(self):
+        sched = self.sched
+
+        async def short():
+            pass
+
+        async def long_lived():
+            await sched.sleep(0.01)
+
+        tracer = Tracer(sched, max_tasks=10).start()
+        keep = sched.new_task(long_lived())
+        for _ in range(50):
+            sched.new_task(short())
+        sched.run()
+        tracer.stop()
+        self.assertLessEqual(len(tracer.tasks), 10)
+        self.assertEqual(len(tracer.tasks) + tracer.pruned, 51)
+        self.assertTrue(keep.done())
+        self.assertIn('long_lived', [s['name'].rsplit('.', 1)[-1] for s in tracer.top(10)])
+        tracer.chrome_trace()       # Events of pruned tasks still export
+
+    def test_metrics_keep_counting_while_tracing(self):
+        sched = self.sched
+        metrics = sched.enable_metrics(slow_callback=None)
+
+        async def step():
+            pass
+
+        tracer = Tracer(sched).start()
+        for _ in range(4):
+            sched.new_task(step())
+        sched.call_soon(lambda: None)
+        sched.run()
+        tracer.stop()
+        self.assertEqual(metrics.callbacks, 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,298 @@
+# timers.py
+#
+# Timer subsystem for the Scheduler in async_io.py.
+#
+# call_later() used to push (deadline, sequence, func) tuples onto a heap.
+# Nothing could take them back out, so a timeout that never fires stayed in
+# the heap until its deadline went by. Every timer is now a TimerHandle with
+# a cancel() method, kept in one of two places:
+#
+#   - precise timers (sleep) stay on a heap. Cancelled entries are left where
+#     they are and skipped when popped; once they make up more than half of
+#     the heap it is rebuilt without them.
+#   - coarse timers (idle/request timeouts) go on a hierarchical timing wheel
+#     with O(1) insert and O(1) cancel. They fire on the first wheel tick at
+#     or after their deadline (never early, at most one tick late).
+
+import heapq
+import math
+import time
+
+
+class TimerHandle:
+    __slots__ = ('deadline', 'sequence', 'func', 'expires',
+                 '_cancelled', '_owner', '_slot', '_level')
+
+    def __init__(self, deadline, sequence, func, owner):
+        self.deadline = deadline      # time.monotonic() value
+        self.sequence = sequence      # Tie breaker for identical deadlines
+        self.func = func
+        self.expires = None           # Wheel tick (coarse timers only)
+        self._cancelled = False
+        self._owner = owner           # TimerQueue while pending, None once fired
+        self._slot = None             # Wheel slot (dict) holding this handle
+        self._level = None
+
+    def __lt__(self, other):
+        if self.deadline == other.deadline:
+            return self.sequence < other.sequence
+        return self.deadline < other.deadline
+
+    def cancel(self):
+        if self._cancelled:
+            return
+        self._cancelled = True
+        self.func = None
+        if self._owner is not None:
+            self._owner._cancel(self)
+            self._owner = None
+
+    def cancelled(self):
+        return self._cancelled
+
+    def pending(self):
+        # Still waiting for its deadline (not fired, not cancelled)
+        return self._owner is not None
+
+    # Fired handles go straight onto the ready queue, so a timer cancelled
+    # after it expired (but before it ran) still doesn't run.
+    def __call__(self):
+        if not self._cancelled:
+            self.func()
+
+
+class TimingWheel:
+    # Four levels: 256 slots of `resolution` seconds each, then three levels
+    # of 64 slots where one slot spans a full turn of the level below. With
+    # the default 10ms tick the wheel covers about 7.7 days; anything further
+    # out is parked in the outermost level and re-inserted when it cascades.
+    LEVEL_BITS = (8, 6, 6, 6)
+
+    def __init__(self, resolution=0.01, now=0.0):
+        self.resolution = resolution
+        self._tick = int(now / resolution)
+        self._shifts = []
+        self._masks = []
+        self._spans = []
+        shift = 0
+        for bits in self.LEVEL_BITS:
+            self._shifts.append(shift)
+            self._masks.append((1 << bits) - 1)
+            shift += bits
+            self._spans.append(1 << shift)
+        self._levels = [[{} for _ in range(1 << bits)] for bits in self.LEVEL_BITS]
+        self._counts = [0] * len(self.LEVEL_BITS)
+        self._len = 0
+
+    def __len__(self):
+        return self._len
+
+    def add(self, handle, now):
+        if not self._len:
+            # An empty wheel doesn't need to tick through the idle period
+            self._tick = max(self._tick, self._target(now))
+        expires = math.ceil(handle.deadline / self.resolution)
+        if expires <= self._tick:
+            expires = self._tick + 1       # Already due: fire on the next tick
+        handle.expires = expires
+        self._insert(handle)
+        self._len += 1
+
+    def remove(self, handle):
+        del handle._slot[handle]
+        handle._slot = None
+        self._counts[handle._level] -= 1
+        self._len -= 1
+
+    def _insert(self, handle):
+        expires = handle.expires
+        diff = expires - self._tick
+        if diff < 0:
+            expires = self._tick            # Overdue while cascading: fire now
+        for level, span in enumerate(self._spans):
+            if diff < span:
+                break
+        else:
+            # Beyond the wheel: park in the farthest slot, re-inserted on cascade
+            expires = self._tick + self._spans[-1] - 1
+        slot = self._levels[level][(expires >> self._shifts[level]) & self._masks[level]]
+        slot[handle] = None
+        handle._slot = slot
+        handle._level = level
+        self._counts[level] += 1
+
+    def _target(self, now):
+        # Tick reached at `now` (the epsilon absorbs float rounding when the
+        # clock lands exactly on a deadline returned by next_deadline())
+        return int(now / self.resolution + 1e-6)
+
+    def _cascade(self, tick):
+        # Entering a tick that completes a turn of level 0 (and maybe of
+        # higher levels). Redistribute the matching outer slots, outermost
+        # first, so everything lands where the lower levels will find it.
+        top = 1
+        while top + 1 < len(self._levels) and not tick & ((1 << self._shifts[top + 1]) - 1):
+            top += 1
+        for level in range(top, 0, -1):
+            slot = self._levels[level][(tick >> self._shifts[level]) & self._masks[level]]
+            if not slot:
+                continue
+            handles = list(slot)
+            slot.clear()
+            self._counts[level] -= len(handles)
+            for handle in handles:
+                self._insert(handle)
+
+    def advance(self, now):
+        # Move the wheel up to `now` and return the handles that expired
+        target = self._target(now)
+        fired = []
+        level0 = self._levels[0]
+        mask0 = self._masks[0]
+        while self._tick < target and self._len:
+            if not self._counts[0]:
+                # Innermost level is empty: skip to the end of its turn
+                last = self._tick | mask0
+                if last >= target:
+                    break
+                self._tick = last
+            self._tick += 1
+            tick = self._tick
+            if not tick & mask0:
+                self._cascade(tick)
+            slot = level0[tick & mask0]
+            if slot:
+                for handle in slot:
+                    handle._slot = None
+                    fired.append(handle)
+                self._counts[0] -= len(slot)
+                self._len -= len(slot)
+                slot.clear()
+        if self._tick < target:
+            self._tick = target
+        return fired
+
+    def next_deadline(self):
+        # Time of the next tick that has work to do (expiry or cascade)
+        if not self._len:
+            return None
+        tick = self._tick
+        wrap = ((tick >> self._shifts[1]) + 1) << self._shifts[1]
+        if self._counts[0]:
+            level0 = self._levels[0]
+            mask0 = self._masks[0]
+            for ahead in range(1, mask0 + 1):
+                if level0[(tick + ahead) & mask0]:
+                    # A timer in a higher level can come due before this
+                    # slot: it moves down at the end of level 0's turn
+                    if self._counts[0] < self._len and wrap < tick + ahead:
+                        return wrap * self.resolution
+                    return (tick + ahead) * self.resolution
+        return wrap * self.resolution
+
+
+class VirtualClock:
+    # Simulated time for tests: a clock that only moves when told to. Pass
+    # one to Scheduler(clock=...) and the Scheduler moves it to the next
+    # deadline whenever it would otherwise sleep, so a program that waits
+    # minutes on timers runs in milliseconds, in the same order every time.
+    def __init__(self, start=0.0):
+        self.now = start
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, delay):
+        self.now += delay
+
+    def advance_to(self, deadline):
+        # Never backwards
+        if deadline > self.now:
+            self.now = deadline
+
+
+class TimerQueue:
+    # Heap for precise timers + timing wheel for coarse ones. len() counts
+    # live (not cancelled, not yet fired) timers.
+    def __init__(self, clock=time.monotonic, resolution=0.01):
+        self.clock = clock
+        self.heap = []
+        self.wheel = TimingWheel(resolution, clock())
+        self.sequence = 0   # sequence number avoids case when deadlines are identical
+        self._live = 0
+        self._heap_cancelled = 0
+
+    def __len__(self):
+        return self._live
+
+    def call_at(self, deadline, func, coarse=False):
+        self.sequence += 1
+        handle = TimerHandle(deadline, self.sequence, func, self)
+        if coarse:
+            self.wheel.add(handle, self.clock())
+        else:
+            heapq.heappush(self.heap, handle)
+        self._live += 1
+        return handle
+
+    def _cancel(self, handle):
+        self._live -= 1
+        if handle._slot is not None:
+            self.wheel.remove(handle)
+            return
+        self._heap_cancelled += 1
+        if self._heap_cancelled > 64 and self._heap_cancelled * 2 > len(self.heap):
+            self.heap = [h for h in self.heap if not h._cancelled]
+            heapq.heapify(self.heap)
+            self._heap_cancelled = 0
+
+    def next_deadline(self):
+        heap = self.heap
+        while heap and heap[0]._cancelled:
+            heapq.heappop(heap)
+            self._heap_cancelled -= 1
+        deadline = heap[0].deadline if heap else None
+        wheel_deadline = self.wheel.next_deadline()
+        if deadline is None or (wheel_deadline is not None and wheel_deadline < deadline):
+            return wheel_deadline
+        return deadline
+
+    def expire(self, now, ready):
+        # Append every timer that is due at `now` to the ready queue
+        heap = self.heap
+        while heap and heap[0].deadline <= now:
+            handle = heapq.heappop(heap)
+            if handle._cancelled:
+                self._heap_cancelled -= 1
+                continue
+            handle._owner = None
+            self._live -= 1
+            ready.append(handle)
+        if self.wheel:
+            fired = self.wheel.advance(now)
+            for handle in fired:
+                handle._owner = None
+            self._live -= len(fired)
+            ready.extend(fired)
+
+
+if __name__ == '__main__':
+    from collections import deque
+
+    timers = TimerQueue()
+    ready = deque()
+    start = timers.clock()
+    for n in range(5):
+        timers.call_at(start + 0.1 * n, lambda n=n: print('precise', n))
+    timeouts = [timers.call_at(start + 0.25, lambda n=n: print('timeout', n), coarse=True)
+                for n in range(100000)]
+    for handle in timeouts[1:]:
+        handle.cancel()             # Requests finished before their timeout
+    print('pending timers:', len(timers))
+    while timers:
+        delay = timers.next_deadline() - timers.clock()
+        if delay > 0:
+            time.sleep(delay)
+        timers.expire(timers.clock(), ready)
+        while ready:
+            ready.popleft()()
@@ -0,0 +1,260 @@
+# tracing.py
+#
+# Opt-in per-task accounting and a timeline for the Scheduler in async_io.py.
+#
+#   tracer = Tracer(sched, max_events=500000)
+#   tracer.start(duration=30)     # Stops by itself after 30 seconds
+#   ...
+#   print(tracer.top(10))         # Tasks that used the most CPU
+#   tracer.export('trace.json')   # Open in https://ui.perfetto.dev
+#
+# While tracing is on, Scheduler.run hands each tick's callbacks to the
+# tracer (like it does to LoopMetrics), and every Task step is timed:
+# resumes, CPU time (thread_time) and the longest single step. That covers
+# the tasks that were already running when start() was called -- on a busy
+# server, the long-lived connection handlers -- as well as new ones. A
+# task is known by its name and a site: where it was created (the first
+# caller outside async_io.py) for tasks created while tracing, where its
+# coroutine function is defined for older ones. Each step, and every
+# poll() the loop makes, also goes into a ring buffer of timeline events,
+# exported in the Chrome Trace Event format. The buffer keeps the last
+# max_events, so memory stays bounded however long the window is. So does
+# the per-task table: beyond max_tasks, the finished tasks that used the
+# least CPU are dropped (tasks still running are always kept).
+#
+# Nothing is paid while tracing is off: Scheduler.run checks one attribute
+# per tick, new_task() one per task, and the poller is only wrapped while
+# tracing.
+
+import json
+import os
+import sys
+import time
+from collections import deque
+
+import async_io
+from async_io import Task
+from timers import TimerHandle
+
+_ASYNC_IO = os.path.abspath(async_io.__file__)
+
+
+class TaskStats:
+    __slots__ = ('id', 'name', 'site', 'created', 'resumes', 'cpu_time',
+                 'run_time', 'max_step', 'done')
+
+    def __init__(self, id, name, site, created):
+        self.id = id
+        self.name = name
+        self.site = site                # 'file.py:123' (see Tracer.task_created)
+        self.created = created          # None: already running at start()
+        self.resumes = 0
+        self.cpu_time = 0.0
+        self.run_time = 0.0
+        self.max_step = 0.0
+        self.done = False
+
+    def as_dict(self):
+        return {'id': self.id, 'name': self.name, 'site': self.site,
+                'resumes': self.resumes, 'cpu_time': self.cpu_time,
+                'run_time': self.run_time, 'max_step': self.max_step,
+                'done': self.done}
+
+
+class _TracingPoller:
+    # Stands in for the Scheduler's poller while tracing: times each poll()
+    def __init__(self, poller, events):
+        self.poller = poller
+        self.events = events
+
+    def __getattr__(self, name):
+        return getattr(self.poller, name)     # register/modify/unregister/...
+
+    def poll(self, timeout=None):
+        start = time.perf_counter()
+        ready = self.poller.poll(timeout)
+        self.events.append((-len(ready) - 1, start, time.perf_counter() - start))
+        return ready
+
+
+class Tracer:
+    def __init__(self, sched, max_events=1000000, max_tasks=10000):
+        self.sched = sched
+        self.events = deque(maxlen=max_events)     # (task id or -1-fds, start, duration)
+        self.max_tasks = max_tasks
+        self.tasks = {}         # id -> TaskStats
+        self.pruned = 0         # Finished tasks dropped from self.tasks
+        self._finished = 0      # Finished tasks in self.tasks
+        self.started = None
+        self.stopped = None
+        self._live = {}         # Task -> TaskStats, while it hasn't finished
+        self._next_id = 0
+        self._timer = None
+        self._poller = None
+
+    def start(self, duration=None):
+        # duration: seconds until stop() is called for you. Its timer keeps
+        # Scheduler.run() alive, like any other timer.
+        if self.sched.tracer is not None:
+            raise RuntimeError('Scheduler is already being traced')
+        self.started = time.perf_counter()
+        self.stopped = None
+        self.sched.tracer = self
+        self._poller = self.sched._poller
+        self.sched._poller = _TracingPoller(self._poller, self.events)
+        if duration is not None:
+            self._timer = self.sched.call_later(duration, self.stop, coarse=True)
+        return self
+
+    def stop(self):
+        if self.sched.tracer is not self:
+            return
+        self.stopped = time.perf_counter()
+        self.sched.tracer = None
+        self.sched._poller = self._poller
+        self._live.clear()          # (don't keep unfinished tasks alive)
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def _add(self, task, site, created):
+        coro = task.coro
+        self._next_id += 1
+        stats = TaskStats(self._next_id, getattr(coro, '__qualname__', repr(coro)),
+                          site, created)
+        self._live[task] = stats
+        self.tasks[stats.id] = stats
+        return stats
+
+    def _finish(self, task, stats):
+        stats.done = True
+        del self._live[task]
+        self._finished += 1
+        # Over max_tasks, with enough finished tasks to be worth a pass:
+        # drop the ones that used the least CPU, down to half of max_tasks
+        # (tasks still running are kept, however many there are)
+        if len(self.tasks) > self.max_tasks and self._finished * 2 > self.max_tasks:
+            finished = sorted((stats for stats in self.tasks.values() if stats.done),
+                              key=lambda stats: stats.cpu_time)
+            for old in finished[:len(self.tasks) - self.max_tasks // 2]:
+                del self.tasks[old.id]
+                self._finished -= 1
+                self.pruned += 1
+
+    def task_created(self, task):
+        # Called by new_task() while tracing
+        frame = sys._getframe(2)       # new_task()'s caller
+        while frame is not None and os.path.abspath(frame.f_code.co_filename) == _ASYNC_IO:
+            frame = frame.f_back
+        site = '%s:%d' % (os.path.basename(frame.f_code.co_filename), frame.f_lineno) if frame else '?'
+        self._add(task, site, time.perf_counter())
+
+    def _adopt(self, task):
+        # First step of a task that was created before start()
+        code = getattr(task.coro, 'cr_code', None)
+        site = '%s:%d' % (os.path.basename(code.co_filename), code.co_firstlineno) if code else '?'
+        return self._add(task, site, None)
+
+    def run_ready(self, ready, count, lane=None):
+        # Scheduler.run's drain of `count` callbacks, with every task step
+        # timed. Keeps LoopMetrics (if enabled too) up to date.
+        metrics = self.sched.metrics
+        threshold = metrics.slow_callback if metrics is not None else None
+        clock = time.perf_counter
+        thread_time = time.thread_time
+        events = self.events
+        live = self._live
+        popleft = ready.popleft
+        tick_start = clock()
+        for _ in range(count):
+            func = popleft()
+            task = func.func if type(func) is TimerHandle else func    # (sleep timers)
+            if not isinstance(task, Task) or task._done:
+                start = clock()
+                func()
+                elapsed = clock() - start
+            else:
+                stats = live.get(task)
+                if stats is None:
+                    stats = self._adopt(task)
+                cpu = thread_time()
+                start = clock()
+                func()
+                elapsed = clock() - start
+                stats.cpu_time += thread_time() - cpu
+                stats.resumes += 1
+                stats.run_time += elapsed
+                if elapsed > stats.max_step:
+                    stats.max_step = elapsed
+                if task._done:
+                    self._finish(task, stats)
+                events.append((stats.id, start, elapsed))
+            if threshold is not None and elapsed > threshold:
+                metrics.slow(func, elapsed)
+        if metrics is not None:
+            metrics.ran(count, clock() - tick_start, lane)
+
+    # ---- Reading the results
+    def top(self, count=10, key='cpu_time'):
+        # The `count` tasks with the most cpu_time (or run_time, max_step, resumes)
+        ranked = sorted(self.tasks.values(), key=lambda stats: getattr(stats, key), reverse=True)
+        return [stats.as_dict() for stats in ranked[:count]]
+
+    def chrome_trace(self):
+        # Chrome Trace Event format ('X' complete events, microseconds)
+        pid = os.getpid()
+        origin = self.started
+        trace = [
+            {'name': 'process_name', 'ph': 'M', 'pid': pid, 'tid': 0,
+             'args': {'name': 'async_io Scheduler'}},
+            {'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': 0,
+             'args': {'name': 'event loop'}},
+        ]
+        tasks = self.tasks
+        for ident, start, duration in self.events:
+            event = {'ph': 'X', 'pid': pid, 'tid': 0,
+                     'ts': (start - origin) * 1e6, 'dur': duration * 1e6}
+            if ident > 0:
+                stats = tasks.get(ident)
+                event['name'] = stats.name if stats is not None else '(pruned task)'
+                event['cat'] = 'task'
+                event['args'] = {'task': ident, 'site': stats.site if stats is not None else '?'}
+            else:
+                event['name'] = 'poll'
+                event['cat'] = 'io'
+                event['args'] = {'ready_fds': -ident - 1}
+            trace.append(event)
+        return {'traceEvents': trace, 'displayTimeUnit': 'ms',
+                'otherData': {'buffer_full': len(self.events) == self.events.maxlen,
+                              'pruned_tasks': self.pruned}}
+
+    def export(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.chrome_trace(), f)
+
+
+if __name__ == '__main__':
+    # One task hogging the loop among well-behaved ones: it tops the list,
+    # although it was started before tracing was
+    from async_io import sched
+
+    async def busy():
+        for _ in range(20):
+            sum(range(200000))      # Blocks everything else for a few ms
+            await sched.sleep(0.01)
+
+    async def polite(n):
+        for _ in range(100):
+            await sched.sleep(0.001)
+
+    sched.new_task(busy())
+    tracer = Tracer(sched).start()
+    for n in range(10):
+        sched.new_task(polite(n))
+    sched.run()
+    tracer.stop()
+    for stats in tracer.top(3):
+        print('%-8s %-16s resumes %3d  cpu %.4fs  max step %.4fs' % (
+            stats['name'], stats['site'], stats['resumes'], stats['cpu_time'], stats['max_step']))
+    tracer.export('trace.json')
+    print('Timeline written to trace.json')
@@ -33,22 +33,28 @@ class Scheduler:
         self.ready.append(coro)
 
     def run(self):
+        # One tick at a time: due timers join the ready queue, then every
+        # task ready at that point takes one step. A task that keeps
+        # yielding goes to the back and can't hold back the sleepers.
         while self.ready or self.sleeping:
             if not self.ready:             # time management exactly like the callback example.
-                deadline, _, coro = heapq.heappop(self.sleeping)
-                delta = deadline - time.time()
+                delta = self.sleeping[0][0] - time.time()
                 if delta > 0:
                     time.sleep(delta)
+            now = time.time()
+            while self.sleeping and self.sleeping[0][0] <= now:
+                deadline, _, coro = heapq.heappop(self.sleeping)
                 self.ready.append(coro)
 
-            self.current = self.ready.popleft()
-            # Drive as a generator
-            try:
-                self.current.send(None)   # next(self.current)  # Together with yield this replaces callbacks in driving the code
-                if self.current:
-                    self.ready.append(self.current)
-            except StopIteration:
-                pass
+            for _ in range(len(self.ready)):
+                self.current = self.ready.popleft()
+                # Drive as a generator
+                try:
+                    self.current.send(None)   # next(self.current)  # Together with yield this replaces callbacks in driving the code
+                    if self.current:
+                        self.ready.append(self.current)
+                except StopIteration:
+                    pass
 
 
 sched = Scheduler()  # Background scheduler object
@@ -77,9 +83,10 @@ async def countup(stop):    # keyword async require to use await
 # Comparing the code above to the original funcs the only difference is adding async and await
 
 
-sched.new_task(countdown(5))
-sched.new_task(countup(20))
-sched.run()
+if __name__ == '__main__':
+    sched.new_task(countdown(5))
+    sched.new_task(countup(20))
+    sched.run()
 
 # Simplifies code over using callbacks: no helper func needed, no recursion needed
 